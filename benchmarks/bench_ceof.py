@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark of the CEOF pipeline on synthetic propagating waves
+
+    Times and measures the peak of memory (tracemalloc) of each stage over
+      a grid of sizes, checks the leading modes of each solver, and their
+      wavelengths and phase speeds, against the known waves (see
+      synthetic.py), and saves everything as JSON, so runs
+      of different versions can be compared:
+
+        python benchmarks/bench_ceof.py --sizes 240x30x40,480x60x80 \\
+                --output new.json --compare old.json
+
+    The exit status is 1 if any solver fails the accuracy check.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from numpy import ma
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, 'ceof'))
+
+from synthetic import synthetic_data, check_modes, check_wavelengths
+from utils import analytic_signal, scaleEOF, ceof_reconstruct, pack, unpack
+from wavelength import wavelength
+import ceof as pyceof
+
+
+# Polygon of the regional CEOF.go, inside the synthetic domain
+POLYGON = [(-57, -3), (-28, -3), (-28, 13), (-57, 13)]
+
+
+def measure(func, repeat=1):
+    """ Best time, in seconds, and peak of memory, in bytes, of func()
+
+        The peak is of the first call, and the output is of the last one.
+    """
+    tracemalloc.start()
+    t0 = time.time()
+    output = func()
+    times = [time.time() - t0]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for n in range(repeat - 1):
+        t0 = time.time()
+        output = func()
+        times.append(time.time() - t0)
+    return min(times), peak, output
+
+
+def _metadata(solver, nmodes, polygon=None):
+    metadata = {'ceof': {'var': 'ssh', 'cumvar': 1, 'maxnmodes': nmodes,
+        'normalize': 'pc_median', 'solver': solver}}
+    if polygon is not None:
+        metadata['ceof_coord'] = polygon
+    return metadata
+
+
+def run_size(shape, mask_fraction, solvers, nmodes, repeat, tol):
+    """ Results of all stages for one size
+    """
+    T, J, K = shape
+    data = synthetic_data(T, J, K, mask_fraction=mask_fraction)
+    valid = ~ma.getmaskarray(data['ssh']).any(axis=0)
+    index = np.flatnonzero(valid)
+    data2D = pack(ma.getdata(data['ssh']), index)
+    results = []
+
+    def record(stage, func, solver=None):
+        try:
+            elapsed, peak, output = measure(func, repeat)
+        except ImportError as err:
+            print("%s %s skipped: %s" % (stage, solver or '', err))
+            return None
+        results.append({'stage': stage, 'solver': solver,
+            'T': T, 'J': J, 'K': K, 'N': int(index.size),
+            'mask_fraction': mask_fraction,
+            'time': elapsed, 'peak_memory': peak})
+        return output
+
+    reference = None
+    for solver in solvers:
+        record('ceof_scalar2D', lambda: pyceof.ceof_scalar2D(data2D,
+            solver=solver, nmodes=nmodes), solver)
+        output = record('CEOF_2D', lambda: pyceof.CEOF_2D(data2D,
+            _metadata(solver, nmodes)['ceof']), solver)
+        if output is None:
+            continue
+        eofs = unpack(output['eofs'], index, (J, K))
+        checks = check_modes(eofs, output['pcs'], data['lon'], data['lat'],
+                tol=tol)
+        # The wavelengths and phase speeds of the pipeline, in m/s
+        wavelengths = wavelength(eofs, output['pcs'], data['lon'],
+                data['lat'], dt=86400.)
+        checks += check_wavelengths(wavelengths, data['lat'], tol=tol)
+        results[-1]['accuracy'] = checks
+        results[-1]['ok'] = all(c['ok'] for c in checks)
+        if reference is None:
+            reference = output
+
+    if reference is None:
+        return results
+
+    solver = [r['solver'] for r in results if r['stage'] == 'CEOF_2D'][0]
+    x = record('CEOF.go', lambda: pyceof.CEOF(data,
+        _metadata(solver, nmodes, POLYGON)), solver)
+    if x is not None:
+        results[-1]['profile'] = x.profile
+        # The stages reset the traced peak
+        results[-1]['peak_memory'] = max([results[-1]['peak_memory']] +
+                [r['traced_peak'] for r in x.profile.values()
+                    if 'traced_peak' in r])
+        # The stages of CEOF.go, on their own
+        record('select_data', lambda: x.select_data('ssh', POLYGON))
+        record('analytic_signal', lambda: analytic_signal(
+            ma.getdata(data['ssh']), index=index))
+        record('set_wavelenght', x.set_wavelenght)
+        record('transform', lambda: x.transform(data['ssh']))
+        # Only the decomposition, evaluated on demand
+        record('CEOF.lazy', lambda: pyceof.CEOF(data,
+            _metadata(solver, nmodes, POLYGON), lazy=True)
+            ['variancefraction'], solver)
+
+    for scaletype in ('pc_median', 'eof_std'):
+        pcs, eofs = reference['pcs'], reference['eofs']
+        record('scaleEOF', lambda: scaleEOF(pcs.copy(), eofs.copy(),
+            scaletype), scaletype)
+
+    eofs = unpack(reference['eofs'], index, (J, K))
+    output = record('ceof_reconstruct', lambda: ceof_reconstruct(eofs,
+        reference['pcs'], nmodes=2))
+    signal = data['signal'][:, valid]
+    error = output[:, valid] - signal
+    results[-1]['accuracy'] = {'rms_error_over_signal':
+            float(np.sqrt((error**2).mean() / (signal**2).mean()))}
+    return results
+
+
+def scaling(results):
+    """ Slope of log(time) with log(T*N) for each stage and solver
+    """
+    output = {}
+    for r in results:
+        output.setdefault((r['stage'], r['solver']), []).append(
+                (r['T'] * r['N'], r['time']))
+    for k in list(output.keys()):
+        x, y = np.log(np.array(output[k]).T)
+        if len(x) > 1 and np.ptp(x) > 0:
+            output[k] = float(np.polyfit(x, y, 1)[0])
+        else:
+            del output[k]
+    return output
+
+
+def report(results, baseline=None):
+    """ Print the results, and the ratio to baseline if given
+    """
+    previous = {}
+    if baseline is not None:
+        for r in baseline['results']:
+            previous[(r['stage'], r['solver'], r['T'], r['J'], r['K'],
+                r['mask_fraction'])] = r
+
+    print("%-16s %-10s %14s %10s %10s %8s" % ('stage', 'solver', 'T x J x K',
+        'time [s]', 'peak [MB]', 'ratio'))
+    for r in results:
+        key = (r['stage'], r['solver'], r['T'], r['J'], r['K'],
+                r['mask_fraction'])
+        ratio = ''
+        if key in previous and previous[key]['time'] > 0:
+            ratio = "%.2f" % (r['time'] / previous[key]['time'])
+        print("%-16s %-10s %14s %10.4f %10.1f %8s %s" % (r['stage'],
+            r['solver'] or '', "%sx%sx%s" % (r['T'], r['J'], r['K']),
+            r['time'], r['peak_memory'] / 1e6, ratio,
+            {True: '', False: 'WRONG MODES'}.get(r.get('ok'), '')))
+
+    slopes = scaling(results)
+    if slopes:
+        print("\nScaling, time ~ (T*N)**slope")
+        for (stage, solver) in sorted(slopes, key=str):
+            print("%-16s %-10s %6.2f" % (stage, solver or '',
+                slopes[(stage, solver)]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='240x30x40,480x60x80,960x90x120',
+            help='comma separated TxJxK sizes')
+    parser.add_argument('--mask-fraction', type=float, default=0.2)
+    parser.add_argument('--solvers', default='svdeofs,gram,randomized',
+            help='comma separated solvers, see solvers.SOLVERS')
+    parser.add_argument('--nmodes', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tol', type=float, default=0.05,
+            help='relative error allowed on the wavenumbers and frequencies')
+    parser.add_argument('--output', default='bench_ceof.json')
+    parser.add_argument('--compare', help='JSON of a previous run')
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(n) for n in s.split('x'))
+            for s in args.sizes.split(',')]
+    solvers = args.solvers.split(',')
+
+    results = []
+    for shape in sizes:
+        print("Benchmarking %sx%sx%s" % shape)
+        results.extend(run_size(shape, args.mask_fraction, solvers,
+            args.nmodes, args.repeat, args.tol))
+
+    with open(os.path.join(ROOT, 'VERSION')) as f:
+        version = f.read().strip()
+    output = {'version': version,
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'arguments': vars(args),
+            'results': results,
+            }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    failed = [r for r in results if r.get('ok') is False]
+    for r in failed:
+        print("%s %s returned wrong modes at %sx%sx%s" % (r['stage'],
+            r['solver'], r['T'], r['J'], r['K']))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Synthetic fields of propagating waves with known modes
+
+    The field is the sum of waves A*envelope*cos(kx*lon + ky*lat - w*t)
+      plus white noise, on a regular lon/lat grid with a daily time axis.
+      Each wave is expected as one complex mode, in the order of the waves,
+      so the leading modes can be checked against the wavenumbers, the
+      frequencies and the phase speeds of the waves.
+
+    The units are degrees and days.
+"""
+
+import datetime
+
+import numpy as np
+from numpy import ma
+
+from wavelength import EARTH_RADIUS
+
+
+# A planar wave moving northeast and a slower, westward Rossby-like wave,
+#   trapped around 5N. The amplitudes set the order of the modes.
+WAVES = (
+        {'name': 'planar', 'amplitude': 2., 'wavelength_x': 10.,
+            'wavelength_y': 40., 'period': 30., 'lat0': None},
+        {'name': 'rossby', 'amplitude': 1., 'wavelength_x': -15.,
+            'wavelength_y': None, 'period': 90., 'lat0': 5.},
+        )
+
+
+def wave_parameters(wave):
+    """ Wavenumbers (kx, ky), in rad/degree, and frequency in rad/day
+    """
+    kx = 2 * np.pi / wave['wavelength_x']
+    if wave['wavelength_y'] is None:
+        ky = 0.
+    else:
+        ky = 2 * np.pi / wave['wavelength_y']
+    return kx, ky, 2 * np.pi / wave['period']
+
+
+def wave_field(wave, t, Lon, Lat):
+    kx, ky, w = wave_parameters(wave)
+    field = wave['amplitude'] * np.cos(kx * Lon[np.newaxis] +
+            ky * Lat[np.newaxis] - w * t[:, np.newaxis, np.newaxis])
+    if wave['lat0'] is not None:
+        field *= np.exp(-((Lat - wave['lat0']) / 8.)**2)
+    return field
+
+
+def synthetic_data(T=120, J=30, K=40, mask_fraction=0., noise=0.5,
+        waves=WAVES, seed=0, dtype='float64'):
+    """ Input dict for CEOF with the field 'ssh', of shape (T, J, K)
+
+        A fraction mask_fraction of the grid points, chosen at random, is
+          masked at all times. The noise-free field is given as 'signal'.
+    """
+    rng = np.random.RandomState(seed)
+    lon = np.linspace(-60, -25, K)
+    lat = np.linspace(-5, 15, J)
+    Lon, Lat = np.meshgrid(lon, lat)
+    t = np.arange(T, dtype='float64')
+
+    signal = np.zeros((T, J, K))
+    for wave in waves:
+        signal += wave_field(wave, t, Lon, Lat)
+    field = (signal + noise * rng.standard_normal((T, J, K))).astype(dtype)
+
+    mask = np.zeros((T, J, K), dtype=bool)
+    mask[:] = rng.rand(J, K) < mask_fraction
+
+    return {'ssh': ma.masked_array(field, mask=mask),
+            'signal': ma.masked_array(signal, mask=mask),
+            'lon': lon, 'lat': lat,
+            'datetime': [datetime.datetime(2000, 1, 1) +
+                datetime.timedelta(days=n) for n in range(T)],
+            }
+
+
+def mode_parameters(eof, pc, lon, lat):
+    """ Estimated (kx, ky, w) of one gridded mode eof (J, K) and its pc
+
+        The phase increments are averaged between neighbours, weighted by
+          their amplitudes, so masked points and the arbitrary phase of the
+          mode don't matter. The analytic signal of a wave cos(k.x - w t) is
+          exp(i(k.x - w t)), so eofs ~ exp(i k.x) and pcs ~ exp(-i w t).
+          The frequency is the slope of the phase of the pc in the central
+          half of the record.
+    """
+    eof = ma.masked_invalid(eof)
+    dlon = lon[1] - lon[0]
+    dlat = lat[1] - lat[0]
+    kx = np.angle(ma.sum(eof[:, 1:] * eof[:, :-1].conj())) / dlon
+    ky = np.angle(ma.sum(eof[1:] * eof[:-1].conj())) / dlat
+    # The ends of the record are distorted by the Hilbert transform
+    T = len(pc)
+    phase = np.unwrap(np.angle(pc[T//4:T - T//4]))
+    w = -np.polyfit(np.arange(len(phase)), phase, 1)[0]
+    return kx, ky, w
+
+
+def check_modes(eofs, pcs, lon, lat, waves=WAVES, tol=0.05):
+    """ Compare the leading modes with the waves
+
+        Returns one dict per wave with the expected and estimated
+          wavenumbers, frequency and zonal phase speed, and ok if the
+          wavenumber vector and the frequency are within a relative error
+          tol.
+    """
+    output = []
+    for n, wave in enumerate(waves):
+        kx, ky, w = wave_parameters(wave)
+        if n >= eofs.shape[-1]:
+            output.append({'wave': wave['name'], 'ok': False})
+            continue
+        ekx, eky, ew = mode_parameters(eofs[..., n], pcs[:, n], lon, lat)
+        k_error = np.hypot(ekx - kx, eky - ky) / np.hypot(kx, ky)
+        w_error = abs(ew - w) / w
+        output.append({'wave': wave['name'],
+            'kx': kx, 'ky': ky, 'w': w, 'c': w / kx,
+            'estimated_kx': float(ekx), 'estimated_ky': float(eky),
+            'estimated_w': float(ew), 'estimated_c': float(ew / ekx),
+            'k_error': float(k_error), 'w_error': float(w_error),
+            'ok': bool((k_error < tol) and (w_error < tol)),
+            })
+    return output
+
+
+def check_wavelengths(output, lat, waves=WAVES, tol=0.05):
+    """ Compare the L_x and c_x of wavelength.wavelength() with the waves
+
+        output is estimated with dt in seconds, i.e. c_x in m/s. The
+          zonal wavenumber, from 2*pi/L_x, and c_x of each mode are
+          converted to degrees and days and their medians over the grid
+          must be within a relative error tol.
+    """
+    # Meters per degree of longitude, by latitude
+    scale = np.deg2rad(1) * EARTH_RADIUS * np.cos(np.deg2rad(lat))
+    scale = scale[:, np.newaxis]
+    result = []
+    for n, wave in enumerate(waves):
+        kx, ky, w = wave_parameters(wave)
+        if n >= output['L_x'].shape[-1]:
+            result.append({'wave': wave['name'], 'ok': False})
+            continue
+        ekx = ma.median(2 * np.pi / (output['L_x'][..., n] * 1e3) * scale)
+        ec = ma.median(output['c_x'][..., n] / scale * 86400)
+        kx_error = abs(ekx - kx) / abs(kx)
+        c_error = abs(ec - w / kx) / abs(w / kx)
+        result.append({'wave': wave['name'], 'kx': kx, 'c': w / kx,
+            'estimated_kx': float(ekx), 'estimated_c': float(ec),
+            'kx_error': float(kx_error), 'c_error': float(c_error),
+            'ok': bool((kx_error < tol) and (c_error < tol)),
+            })
+    return result
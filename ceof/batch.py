@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CEOF of many configurations of the same input, sharing the preprocessing
+
+    A configuration is a metadata dict as used by CEOF: 'ceof', with the
+      var and the CEOF_2D cfg, and optionally 'ceof_coord' and 'prefilter'.
+
+    The grid is built once. The configurations are grouped by (var,
+      prefilter, dtype, gappy), and each group is filtered, packed and
+      Hilbert transformed only once, on the union of the regions of its
+      configurations. Since the Hilbert transform is along time, the
+      analytic signal of a region is a subset of the columns of the one of
+      the union. Only the
+      decompositions, by CEOF_2D, are done per configuration, optionally in
+      a pool of processes.
+
+    The gappy configurations (see gappy) are grouped by min_valid, and
+      share the packed field, since the analytic signal is estimated at
+      each iteration of the filling of the gaps.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+from numpy import ma
+
+from utils import analytic_signal, pack, unpack
+from ceof import CEOF_2D
+from regions import polygon_mask
+from filters import prefilter
+from workers import get_n_workers
+
+
+logger = logging.getLogger('ceof.batch')
+
+
+def _group_key(metadata):
+    """ The configurations with the same key share the analytic signal
+
+        The last item is the min_valid of the gappy configurations, or None
+          otherwise, as in CEOF.
+    """
+    p = metadata.get('prefilter')
+    if p is not None:
+        p = repr(sorted(p.items()))
+    cfg = metadata['ceof']
+    min_valid = None
+    if cfg.get('gappy'):
+        min_valid = cfg.get('min_valid', 0.5)
+    return (cfg['var'], p, cfg.get('dtype'), min_valid)
+
+
+def _decompose(args):
+    """ Worker of CEOF_batch(), CEOF_2D of the columns cols of U
+
+        U can be an array or the filename of a .npy, which is memory mapped,
+          with the mask, if any, in the .mask.npy next to it.
+    """
+    U, cols, cfg = args
+    if isinstance(U, str):
+        maskfile = U[:-4] + '.mask.npy'
+        U = np.load(U, mmap_mode='r')
+        if os.path.exists(maskfile):
+            U = ma.masked_array(U, mask=np.load(maskfile, mmap_mode='r'))
+    return CEOF_2D(U[:, cols], cfg)
+
+
+def CEOF_batch(data, configurations, n_workers=None):
+    """ CEOF of data for each one of configurations
+
+        data is a dict like the input of CEOF. configurations is a dict of
+          metadata, or a list of them, in which case they are keyed by
+          their position.
+
+        Returns a dict with the same keys as configurations, where each
+          item has eofs (gridded), pcs, lambdas, variancefraction and
+          grid_index, like on CEOF, plus the halfpower_period if
+          prefiltered.
+
+        The decompositions of a group run as soon as its analytic signal is
+          ready, so only one is in memory at a time.
+
+        n_workers caps the workers as on CEOF, see workers. The prefilter
+          and the Hilbert transform run in n_workers threads. With more
+          than one worker, the decompositions run in a pool of n_workers
+          processes, with a single thread each, which read their columns
+          from the analytic signals saved in temporary memmaps. Otherwise
+          they run here, with cfg['n_workers'] = n_workers if given.
+    """
+    if not hasattr(configurations, 'keys'):
+        configurations = dict(enumerate(configurations))
+
+    if ('Lat' in data) and ('Lon' in data):
+        Lon, Lat = data['Lon'], data['Lat']
+    else:
+        Lon, Lat = np.meshgrid(data['lon'], data['lat'])
+
+    groups = {}
+    for k in configurations:
+        groups.setdefault(_group_key(configurations[k]), []).append(k)
+
+    processes = get_n_workers(n_workers)
+    decompose_workers = n_workers
+    tmpdir = None
+    if processes > 1:
+        tmpdir = tempfile.mkdtemp(prefix='ceof_batch_')
+        # The processes share the cap, one thread each
+        decompose_workers = 1
+
+    try:
+        tasks, regions, results, outputs = [], [], [], {}
+        for g, (var, p, dtype, min_valid) in enumerate(groups):
+            members = groups[(var, p, dtype, min_valid)]
+            field = data[var]
+            halfpower_period = None
+            metadata = configurations[members[0]]
+            if 'prefilter' in metadata:
+                logger.info("Filtering %s in time", var)
+                field, halfpower_period = prefilter(field,
+                        data['datetime'], n_workers=n_workers,
+                        **metadata['prefilter'])
+
+            mask = ma.getmaskarray(field)
+            if min_valid is None:
+                valid = mask.any(axis=0) == False
+            else:
+                T = mask.shape[0]
+                valid = T - mask.sum(axis=0) >= \
+                        max(1, int(np.ceil(min_valid * T)))
+            del mask
+            shape = valid.shape
+            masks = {}
+            for k in members:
+                coord = configurations[k].get('ceof_coord')
+                if coord is None:
+                    masks[k] = valid
+                else:
+                    masks[k] = valid & polygon_mask(Lon, Lat, coord)
+            union = np.any([masks[k] for k in members], axis=0)
+            index = np.flatnonzero(union)
+
+            if min_valid is None:
+                logger.info("Hilbert transform of %s on %s points", var,
+                        index.size)
+                U = analytic_signal(ma.getdata(field), index=index,
+                        dtype=dtype, n_workers=n_workers)
+            else:
+                # The analytic signal is estimated by gappy, with the gaps
+                U = ma.masked_array(pack(field, index))
+            if tmpdir is not None:
+                filename = os.path.join(tmpdir, 'U_%s.npy' % g)
+                np.save(filename, ma.getdata(U))
+                if ma.getmask(U) is not ma.nomask:
+                    np.save(filename[:-4] + '.mask.npy', ma.getmask(U))
+                U = filename
+
+            group = []
+            for k in members:
+                region = np.flatnonzero(masks[k])
+                cols = np.searchsorted(index, region)
+                cfg = configurations[k]['ceof']
+                if decompose_workers is not None:
+                    cfg = dict(cfg, n_workers=decompose_workers)
+                group.append((U, cols, cfg))
+                regions.append((k, region, shape, halfpower_period))
+            if tmpdir is None:
+                logger.info("Running %s decompositions", len(group))
+                results.extend(_decompose(t) for t in group)
+            else:
+                tasks.extend(group)
+            del U, group
+
+        if tmpdir is not None:
+            logger.info("Running %s decompositions", len(tasks))
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_decompose, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    for (k, region, shape, halfpower_period), output in zip(regions, results):
+        output['grid_index'] = np.column_stack(
+                np.unravel_index(region, shape))
+        output['eofs'] = unpack(output['eofs'], region, shape)
+        if halfpower_period is not None:
+            output['halfpower_period'] = halfpower_period
+        outputs[k] = output
+
+    return outputs
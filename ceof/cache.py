@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Content-addressed cache of the decomposition of CEOF_2D
+
+    The key is a fingerprint of the input array plus the solver-relevant
+      configuration, so runs on the same input that only change the
+      normalization, cumvar or the plotting options reuse the Hilbert
+      transform and the decomposition.
+
+    The fingerprint hashes the shape, the dtype, some contiguous blocks
+      evenly spaced along the array and a strided sample of all of it.
+      That is fast on huge arrays but, in principle, two arrays differing
+      only between the samples would collide. Use ResultCache(full=True)
+      to hash the whole array instead.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def fingerprint(data, full=False, nblocks=16, blocksize=2**16, nsamples=2**16):
+    """ Fast hash of an array: shape, dtype and sampled blocks of it
+    """
+    h = hashlib.sha1()
+    h.update(str((data.shape, data.dtype.str)).encode('ascii'))
+    flat = np.ravel(data)
+    if full:
+        h.update(np.ascontiguousarray(flat).tobytes())
+        return h.hexdigest()
+
+    n = flat.size
+    if n <= nblocks * blocksize + nsamples:
+        h.update(np.ascontiguousarray(flat).tobytes())
+    else:
+        for start in np.linspace(0, n - blocksize, nblocks).astype('int64'):
+            block = flat[start:start+blocksize]
+            h.update(np.ascontiguousarray(block).tobytes())
+        h.update(np.ascontiguousarray(flat[::n // nsamples]).tobytes())
+    return h.hexdigest()
+
+
+class CacheStats(object):
+    """ Counters of a ResultCache
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "CacheStats(hits=%s (memory=%s, disk=%s), misses=%s, " \
+                "evictions=%s)" % (self.hits, self.memory_hits,
+                        self.disk_hits, self.misses, self.evictions)
+
+
+class ResultCache(object):
+    """ Cache of (pcs, lambdas, eofs, totalvar) with two tiers
+
+        An in-memory LRU limited to maxmemory bytes and, if directory is
+          given, an on-disk tier limited to maxdisk bytes, where the least
+          recently used entries are evicted first. The cached arrays are
+          shared, so they must not be modified in place.
+    """
+    names = ('pcs', 'lambdas', 'eofs', 'totalvar')
+
+    def __init__(self, maxmemory=2**30, directory=None, maxdisk=2**34,
+            full=False):
+        self.maxmemory = maxmemory
+        self.directory = directory
+        self.maxdisk = maxdisk
+        self.full = full
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.stats = CacheStats()
+        if (directory is not None) and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __getstate__(self):
+        # Don't carry the cached results around, like on pickled metadata
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        state['memory_size'] = 0
+        return state
+
+    def key(self, data, solver='svdeofs', nmodes=None, solver_kw=None,
+            dtype=None, index=None):
+        """ Key of the decomposition of data with solver
+
+            With index, data is a gridded field and the decomposition is of
+              its points index, as in utils.pack(data, index), so the key
+              is known before packing or transforming it.
+        """
+        if solver == 'svdeofs':
+            # Always computes all modes
+            nmodes = None
+        cfg = (solver, nmodes, sorted((solver_kw or {}).items()))
+        if (dtype is not None) and not np.iscomplexobj(data):
+            cfg += (np.dtype(dtype).str,)
+        cfg = repr(cfg)
+        h = hashlib.sha1(fingerprint(data, self.full).encode('ascii'))
+        h.update(cfg.encode('ascii'))
+        if index is not None:
+            h.update(np.asarray(index, dtype='int64').tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Cached result of key, or None
+        """
+        if key in self.memory:
+            self.memory[key] = self.memory.pop(key)
+            self.stats.hits += 1
+            self.stats.memory_hits += 1
+            return self.memory[key]
+
+        value = self._disk_get(key)
+        if value is not None:
+            self.stats.hits += 1
+            self.stats.disk_hits += 1
+            self._memory_put(key, value)
+            return value
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, key, value):
+        """ Cache value, (pcs, lambdas, eofs, totalvar), as key
+        """
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_size = 0
+        if self.directory is not None:
+            for k in os.listdir(self.directory):
+                shutil.rmtree(os.path.join(self.directory, k), True)
+
+    def _memory_put(self, key, value):
+        size = sum(np.asarray(v).nbytes for v in value)
+        if (size > self.maxmemory) or (key in self.memory):
+            return
+        self.memory[key] = value
+        self.memory_size += size
+        while self.memory_size > self.maxmemory:
+            k, v = self.memory.popitem(last=False)
+            self.memory_size -= sum(np.asarray(x).nbytes for x in v)
+            self.stats.evictions += 1
+
+    def _disk_get(self, key):
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            value = tuple(np.load(os.path.join(path, n + '.npy'))
+                    for n in self.names)
+        except (IOError, OSError, ValueError):
+            return None
+        os.utime(path, None)
+        return value[:3] + (value[3][()],)
+
+    def _disk_put(self, key, value):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            return
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        for n, v in zip(self.names, value):
+            np.save(os.path.join(tmp, n + '.npy'), v)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Written meanwhile by another process
+            shutil.rmtree(tmp, True)
+        self._disk_evict()
+
+    def _disk_evict(self):
+        entries = []
+        for k in os.listdir(self.directory):
+            path = os.path.join(self.directory, k)
+            if k.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f))
+                    for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        while entries and total > self.maxdisk:
+            mtime, size, path = entries.pop(0)
+            shutil.rmtree(path, True)
+            total -= size
+            self.stats.evictions += 1
+
+
+default_cache = ResultCache()
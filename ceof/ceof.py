@@ -4,24 +4,58 @@
 """ Class to deal with Complex EOF
 """
 
-from UserDict import UserDict
+try:
+    from UserDict import UserDict
+except ImportError:
+    from collections import UserDict
+from collections import OrderedDict
+
+import logging
 
 import numpy
 import numpy as np
 from numpy import ma
-import scipy.fftpack
 
-from pyclimate.svdeofs import svdeofs, getvariancefraction
+from utils import analytic_signal, ceof_output, ceof_reconstruct, pack, unpack
+from utils import eof_projection, ceof_transform
+from solvers import decompose
+from gappy import decompose_gappy
+from regions import polygon_mask
+from filters import prefilter
+import store
+import cache
+from timing import StageProfiler
+from wavelength import wavelength
+from workers import map_blocks, split_blocksize, limit_threads
+
 
-from utils import scaleEOF
+logger = logging.getLogger('ceof')
 
 
-def ceof_scalar2D(data):
+def ceof_scalar2D(data, solver='svdeofs', nmodes=None, full_output=False,
+        dtype=None, n_workers=None, **keywords):
     """ Estimate the complex EOF on a 2D array.
 
         Time should be the first dimension, so that the PC (eigenvalues) will
           be in respect to the first dimension.
 
+        The solver can be one of solvers.SOLVERS. The default, svdeofs,
+          computes all the modes, while randomized and arpack compute only
+          the leading nmodes. The gram solver uses the method of snapshots,
+          eigendecomposing the smaller of U U^H or U^H U, which is much
+          cheaper for strongly rectangular U; see solvers.svd_gram for its
+          tolerance. Extra keywords are passed to the solver.
+
+        With full_output, the total variance (trace of U^H U / T) is also
+          returned, so that truncated solutions can be normalized.
+
+        A complex data is taken as the analytic signal itself, as given by
+          utils.analytic_signal(), and used as it is. dtype sets the
+          precision of the analytic signal of a real data, like float32 for
+          a single precision (complex64) decomposition.
+
+        n_workers sets the threads of the Hilbert transform and caps the
+          BLAS threads of the solver, see workers.
     """
     assert type(data) is np.ndarray, \
         "ceof_scalar2D requires an ndarray but got: %s" % type(data)
@@ -29,19 +63,51 @@ def ceof_scalar2D(data):
         "ceof_scalar2D requires a full valid values array"
 
     # ---- Creating the complex field using Hilbert transform
-    input_H = numpy.empty(data.shape, dtype=data.dtype)
-    for i in range(data.shape[1]):
-        input_H[:,i] = scipy.fftpack.hilbert(data[:,i])
-
-    U = data + 1j*input_H
+    if np.iscomplexobj(data):
+        U = data
+    else:
+        U = analytic_signal(data, dtype=dtype, n_workers=n_workers)
 
-    pcs, lambdas, eofs = svdeofs(U)
+    with limit_threads(n_workers):
+        pcs, lambdas, eofs, totalvar = decompose(U, solver, nmodes,
+                **keywords)
 
+    if full_output:
+        return pcs, lambdas, eofs, totalvar
     return pcs, lambdas, eofs
 
 
 def CEOF_2D(data, cfg=None):
     """ Complex EOF of a scalar 2D array
+
+        cfg['solver'] defines the solver used by ceof_scalar2D (default
+          svdeofs). The truncated solvers (randomized, arpack) compute only
+          cfg['maxnmodes'] modes, while gram computes all modes unless
+          cfg['maxnmodes'] is given. cfg['solver_kw'] is an optional dict
+          of extra arguments for the solver, like {'side': 'time'} for gram,
+          which otherwise picks the side from the shape of the data. In any
+          case the variancefraction is relative to the total variance.
+
+        If cfg['cache'] is a cache.ResultCache, or True for the
+          cache.default_cache, the decomposition is cached by the content
+          of data and the solver configuration. The normalization and the
+          mode selection are applied after the cache.
+
+        cfg['dtype'] = 'float32' runs the Hilbert transform and the solver
+          in single precision (complex64), which halves the memory and
+          roughly the time of both. data can also be the complex analytic
+          signal, see ceof_scalar2D.
+
+        cfg['n_workers'] is the number of threads of ceof_scalar2D.
+
+        The pcs of new data (T', N) on these modes are
+          utils.ceof_transform(data, utils.eof_projection(output['eofs'])).
+
+        With cfg['gappy'], True or a dict of options of gappy.fill_gaps(),
+          data can have gaps, masked or NaN, which are filled iteratively
+          by the leading cfg['maxnmodes'] modes, see gappy. Instead of
+          cfg['cache'], the solution is kept to start a rerun with more
+          modes.
     """
     assert data.ndim == 2, "CEOF_2D requires a 2D ndarray input"
 
@@ -53,51 +119,76 @@ def CEOF_2D(data, cfg=None):
     #if self['input'].mask.any():
     #    print "There are masked values in U at CEOF_2D()"
 
-    pcs, lambdas, eofs = ceof_scalar2D(data)
-
-    expvar = getvariancefraction(lambdas)
-
-    # Define how many modes will be returned by the explainned variance.
-    # cumvar = 1 means 100%, i.e. all modes
-    if cfg['cumvar'] == 1:
-        nmodes = len(lambdas)
-    else:
-        # This doesn't work. Need to improve it.
-        nmodes = (np.arange(len(expvar))[np.cumsum(expvar)>=cfg['cumvar']])[0]
-
-    if 'maxnmodes' in cfg:
-        nmodes = min(nmodes, cfg['maxnmodes'])
-
-    print("Considering the first %s of %s modes." % (nmodes,len(lambdas)))
-
-    # ---- Normalize -----------------------------------------------------
-    if 'normalize' in  cfg:
-        pcs, eofs = scaleEOF(pcs, eofs, scaletype=cfg['normalize'])
-
-    output = {}
-    output['eofs'] = eofs[:,:nmodes]
-    output['pcs'] = pcs[:,:nmodes]
-    output['lambdas'] = lambdas[:nmodes]
-    output['variancefraction'] = expvar[:nmodes]
-
-    return output
-
-
-def make_animation(data, eofdata, t, lat, lon, outputfilename, limits = None):
+    # ---- Gaps filled by the modes
+    gappy = cfg.get('gappy')
+    if gappy:
+        assert 'maxnmodes' in cfg, "A gappy CEOF_2D requires maxnmodes"
+        if gappy is True:
+            gappy = {}
+        result = decompose_gappy(ma.masked_invalid(data), cfg['maxnmodes'],
+                dtype=cfg.get('dtype'), n_workers=cfg.get('n_workers'),
+                **gappy)
+        return ceof_output(result, cfg)
+
+    # ---- Cached decomposition
+    return ceof_output(_decomposition(data, cfg), cfg)
+
+
+def _decomposition(data, cfg, index=None, n_workers=None, stage=None):
+    """ (pcs, lambdas, eofs, totalvar) of data by cfg, through cfg['cache']
+
+        With index, data is a gridded field (T, J, K) and the analytic
+          signal of its points index is built only on a cache miss, in the
+          'hilbert' stage, by n_workers threads (default cfg['n_workers']).
+          stage is a StageProfiler.stage, to time it apart from the
+          'decomposition'.
+    """
+    solver = cfg.get('solver', 'svdeofs')
+    solver_kw = cfg.get('solver_kw', {})
+    dtype = cfg.get('dtype')
+    if n_workers is None:
+        n_workers = cfg.get('n_workers')
+    if stage is None:
+        stage = StageProfiler(enabled=False).stage
+
+    result = None
+    rcache = cfg.get('cache')
+    if rcache is True:
+        rcache = cache.default_cache
+    if rcache:
+        key = rcache.key(data, solver, cfg.get('maxnmodes'), solver_kw,
+                dtype, index=index)
+        result = rcache.get(key)
+    if result is None:
+        if index is not None:
+            # The analytic signal is built straight from the field, without
+            #   a packed real copy of it.
+            with stage('hilbert'):
+                data = analytic_signal(data, index=index, dtype=dtype,
+                        n_workers=n_workers)
+        with stage('decomposition'):
+            result = ceof_scalar2D(data, solver=solver,
+                    nmodes=cfg.get('maxnmodes'), full_output=True,
+                    dtype=dtype, n_workers=n_workers, **solver_kw)
+        if rcache:
+            rcache.put(key, result)
+    return result
+
+
+def make_animation(data, eofdata, t, lat, lon, outputfilename, limits = None,
+        fps=2, size=(800, 600), encoder='mencoder', n_workers=None):
+    """ Animation of data and its EOF reconstruction, eofdata
+
+        The frames are piped straight to encoder (mencoder or ffmpeg), see
+          graphics.write_animation(). size is (width, height) in pixels,
+          and with n_workers segments of frames are encoded in parallel.
+    """
     import matplotlib
     matplotlib.use('Agg')
-    import matplotlib.pyplot as plt   # For plotting graphs.
-    import pylab
-    from mpl_toolkits.basemap import Basemap
-
-    #import numpy as np
-    #import subprocess                 # For issuing commands to the OS.
-    import os
-    import sys                        # For determining the Python version.
 
     not_found_msg = """
-    The mencoder command was not found;
-    mencoder is used by this script to make an avi file from a set of pngs.
+    The %s command was not found;
+    it is used by this script to encode the animation.
     It is typically not installed by default on linux distros because of
     legal restrictions, but it is widely available.
     """
@@ -113,73 +204,17 @@ def make_animation(data, eofdata, t, lat, lon, outputfilename, limits = None):
         LonIni = limits['LonIni']
         LonFin = limits['LonFin']
 
-    #try:
-    #    subprocess.check_call(['mencoder'])
-    #except subprocess.CalledProcessError:
-    #    print "mencoder command was found"
-    #    pass # mencoder is found, but returns non-zero exit as expected
-    #         # This is a quick and dirty check; it leaves some spurious output
-    #	     # for the user to puzzle over.
-    #except OSError:
-    #	 print not_found_msg
-    #     sys.exit("quitting\n")
-
-    parallels = numpy.arange(-5,20.1,5)
-    meridians = numpy.arange(300,340,10)
-    V = list(range(-20, 21, 1))
-    for i in range(len(t)) :
-        #fig = plt.figure(figsize=(14,10.5), dpi=100)
-        pylab.subplot(211)
-        map = Basemap(projection='merc',lat_ts=0,llcrnrlon=LonIni,llcrnrlat=LatIni, urcrnrlon=LonFin, urcrnrlat=LatFin,resolution='l',area_thresh=1000.)
-        X, Y = list(map(*pylab.meshgrid(lon, lat)))
-        map.contourf(X,Y, data[i], V)
-        plt.colorbar(shrink=0.8)
-        map.drawcoastlines()
-        map.fillcontinents(color='0.0')
-        map.drawparallels(parallels,labels=[1,0,0,1])
-        map.drawmeridians(meridians,labels=[1,0,0,1])
-        plt.title('%s' % (t[i].strftime('%Y-%m-%d')))
-        #
-        pylab.subplot(212)
-        map = Basemap(projection='merc',lat_ts=0,llcrnrlon=LonIni,llcrnrlat=LatIni, urcrnrlon=LonFin, urcrnrlat=LatFin,resolution='l',area_thresh=1000.)
-        X, Y = list(map(*pylab.meshgrid(lon, lat)))
-        map.contourf(X,Y, eofdata[i], V)
-        plt.colorbar(shrink=0.8)
-        map.drawcoastlines()
-        map.fillcontinents(color='0.0')
-        map.drawparallels(parallels,labels=[1,0,0,1])
-        map.drawmeridians(meridians,labels=[1,0,0,1])
-        plt.title('%s (EOF reconstructed)' % (t[i].strftime('%Y-%m-%d')))
-        # ----
-        filename = str('../tmp/%04d' % i) + '.png'
-        plt.savefig(filename, dpi=100)
-        print('Wrote file', filename)
-        #
-        # Clear the figure to make way for the next image.
-        #
-        plt.clf()
-
-    command = ('mencoder',
-               'mf://../tmp/*.png',
-               '-mf',
-               'type=png:w=800:h=600:fps=2',
-               '-ovc',
-               'lavc',
-               '-lavcopts',
-               'vcodec=mpeg4',
-               '-oac',
-               'copy',
-               '-o',
-               outputfilename)
-    
-    os.spawnvp(os.P_WAIT, 'mencoder', command)
-
-    #print "\n\nabout to execute:\n%s\n\n" % ' '.join(command)
-    #subprocess.check_call(command)
-
-    print("\n\n The movie was written to 'output.avi'")
-
-    print("\n\n You may want to delete *.png now.\n\n")
+    import graphics
+    try:
+        graphics.write_animation(data, eofdata, t, lat, lon, outputfilename,
+                limits={'LatIni':LatIni, 'LatFin':LatFin,
+                    'LonIni':LonIni, 'LonFin':LonFin},
+                fps=fps, size=size, encoder=encoder, n_workers=n_workers)
+    except OSError:
+        logger.error(not_found_msg, encoder)
+        raise
+
+    logger.info("The movie was written to '%s'", outputfilename)
     return
 
 
@@ -187,30 +222,30 @@ class CEOF_Filter():
     """ Unfinished
     
         This will be a class to filter using EOF. One define the number of modes
-	  or the desired variability to be explainned. The field is decomposed
-	  by CEOF, than the field is reconstructed considering only the n first
-	  modes.
+          or the desired variability to be explainned. The field is decomposed
+          by CEOF, than the field is reconstructed considering only the n first
+          modes.
 
 
 
     """
     def __init__(self,input,metadata={'variancefraction_explainned':0.95}):
         """
-	"""
-	N = pcs.shape[1]    # Now it is all the modes.
+        """
+        N = pcs.shape[1]    # Now it is all the modes.
         T = pcs.shape[0]
-	I = eofs.shape[0]
-	J = eofs.shape[1]
+        I = eofs.shape[0]
+        J = eofs.shape[1]
         data_filtered = numpy.zeros((T, I, J))
 
         eof_amp=(eof.real**2+eof.imag**2)**0.5
         eof_phase=numpy.arctan2(eof.imag,eof.real)
         pc_amp = (numpy.real(pc)**2+numpy.imag(pc)**2)**0.5
-        pc_phase = numpy.arctan2(numpy.imag(pc),numpy.real(pc))	
+        pc_phase = numpy.arctan2(numpy.imag(pc),numpy.real(pc))
 
-	for t in range(T):
+        for t in range(T):
             for n in range(N):
-	        data_filtered[t] = data_filtered[t] + eof_amp[:,:,n]*pc_amp[t,n]*numpy.cos(eof_phase[:,:,n]+pc_phase[t,n])
+                data_filtered[t] = data_filtered[t] + eof_amp[:,:,n]*pc_amp[t,n]*numpy.cos(eof_phase[:,:,n]+pc_phase[t,n])
         return
 
 def CEOF_2D_limited(input,metadata={'variancefraction_explainned':0.95}):
@@ -236,261 +271,342 @@ def CEOF_2D_limited(input,metadata={'variancefraction_explainned':0.95}):
 class CEOF(UserDict):
     """
     """
-    def __init__(self, input, metadata={}, logger=None, **keywords):
+    def __init__(self, input, metadata={}, logger=None, copy=True,
+            profile=True, callback=None, n_workers=None, lazy=False,
+            **keywords):
         """
             Time should be the first dimension, i.e. axis=0
+
+            With copy=False, input is kept as it is, and the results are
+              added to a new dict referencing its arrays, which are never
+              modified, so they can be views or memmaps. The field is only
+              copied when a prefilter changes it.
+
+            The diagnostics go to logger, by default the 'ceof' logger. With
+              profile, the time and memory of each stage of go() are
+              logged and kept in the dict self.profile, and passed to
+              callback(stage, record) if given, see timing.StageProfiler.
+
+            n_workers is the number of threads of the masking, prefilter,
+              Hilbert transform and wavelength stages, and the cap of the
+              BLAS threads of the whole run, see workers. The default is
+              to run those stages serially. It is also the number of
+              processes of the figures, unless metadata['figs'] sets its
+              own n_workers.
+
+            With lazy, nothing is computed here. Each item of products()
+              is evaluated on its first access through the dict interface,
+              with the stages it depends on, and kept for the next ones.
+              So x['variancefraction'] runs only the decomposition, and
+              x.eof(0) unpacks only the first mode. Otherwise, the packed
+              eofs are dropped once unpacked, and repacked from the eofs
+              when needed.
+
+            With metadata['ceof']['gappy'], see CEOF_2D, the points valid
+              on at least a fraction metadata['ceof']['min_valid'] (0.5 by
+              default) of the times are used, and their gaps are filled.
         """
-        self.input = input.copy()
-        self.data = input.copy()
+        if logger is None:
+            logger = logging.getLogger('ceof')
+        self.logger = logger
+        self.profiler = StageProfiler(logger, callback, enabled=profile)
+        self.profile = self.profiler.profile
+
+        if copy:
+            self.input = input.copy()
+        else:
+            self.input = input
+        self.data = dict(input)
         self.metadata = metadata
-
-        self.go()
+        self.n_workers = n_workers
+        self.lazy = lazy
+        self._modes = {}
+        self._reconstructions = {}
+        self._projection = None
+
+        if not lazy:
+            self.go()
         return
 
-    def filter(self,var,l,type,l2=None):
-        #from maud import window_mean
-        from maud import window_1Dmean_grid, get_halfpower_period
-        from datetime import timedelta
-        
-        if len((set(numpy.diff(self.data['datetime'])))) !=1:
-            print("Class incomplete. Can't deal with a non regular time series")
-            return
-
-        dt=self.data['datetime'][1]-self.data['datetime'][0]
-        if type == 'bandpass':
-            tscale = dt.days+dt.seconds/86400.
-            ll = (l.days+l.seconds/86400.)/tscale
-            ll2 = (l2.days+l2.seconds/86400.)/tscale
-            #lowpass = window_mean.window_1Dmean_grid(self.data[var], ll/2., method='hann', axis=0)
-            lowpass = window_1Dmean_grid(self.data[var], ll/2., method='hann', axis=0)
-            output = window_1Dmean_grid(lowpass, ll2/2., method='hann', axis=0)
-            output = lowpass - output
-
-            print("ATENTION!!!! Improve this here!!!")
-            self.halfpower_period = "20-120"
-        else:
-            ll=(l.days+l.seconds/86400.)/(dt.days+dt.seconds/86400.)
-
-            if ll<1:
-                print("This filter will have no effect. Data series have not enough resolution.")
-                return
-
-            lowpass = window_1Dmean_grid(self.data[var],ll/2.,method='hann',axis=0)
-            #lowpass=window_mean.window_1Dmean(self.data[var],ll,method='hanning',axis=0)
-            if type=='lowpass':
-                output=lowpass
-            elif type=='highpass':
-                #self.data[var]=x_highpass=self.data[var]-(lowpass-lowpass.mean())
-                output=self.data[var]-(lowpass)
-                #output=self.data[var]-lowpass
-            else:
-                print("On function filter, type must be lowpass or highpass")
-
-            halfpower_period = get_halfpower_period(self.data[var],
-                    output, dt=dt)
-            print("Filter half window size: %s" % l)
-            print("Half Power Period: %s" % halfpower_period)
-            self.halfpower_period = halfpower_period
-        
-        # ----
-	## I should move this to inside the window_mean_1D_grid
-	#nt,ni,nj = self.data[var].shape
-	#gain = ma.masked_all((nt,ni,nj))
-	#for i in range(ni):
-	#    for j in range(nj):
-	#        if output[:,i,j].mask.all()==False:
-        #            gain[:,i,j] = numpy.absolute(numpy.fft.fft(output[:,i,j]-output[:,i,j].mean())) / numpy.absolute(numpy.fft.fft(self.data[var][:,i,j]-self.data[var][:,i,j].mean()))
-	#gain_median = ma.masked_all(nt)
-	#for t in range(nt):
-	#    gain_median[t] = numpy.median(gain[t,:,:].compressed()[numpy.isfinite(gain[t,:,:].compressed())])
-	#freq=numpy.fft.fftfreq(nt)/dt.days
-	#import rpy2.robjects as robjects
-	#smooth = robjects.r['smooth.spline'](robjects.FloatVector(gain_median[numpy.ceil(nt/2.):]),robjects.FloatVector(-freq[numpy.ceil(nt/2.):]),spar=.4)
-	##smooth = robjects.r['smooth.spline'](robjects.FloatVector(-freq[numpy.ceil(nt/2.):]),robjects.FloatVector(gain_median[numpy.ceil(nt/2.):]),spar=.4)
-	#s_interp = robjects.r['predict'](smooth,x=0.5)
-	#halfpower_period = 1./s_interp.rx2['y'][0]
-
-        # ----
-        self.data[var]=output
-
-        return
+    def products(self):
+        """ Items evaluated on demand, with the method that sets them
 
-    def select_data(self, var, polygon_coordinates):
+            In the order of evaluation of go(). The wavelength items are
+              not available if metadata['wavelength'] is False, nor the
+              figures without metadata['figs'].
         """
-        """
-        #var = 'ssh'
-        T,I,J = self.data[var].shape
-        tmp=numpy.ones((J,K))==1
-        for i in range(I):
-            for j in range(J):
-                   tmp[i,j] = ((self.data[var].mask)[:,i,j]).all()==False
+        products = OrderedDict()
+        for k in ('Lon', 'Lat'):
+            products[k] = '_set_grid'
+        for k in ('pcs', 'lambdas', 'variancefraction', 'packed_eofs'):
+            products[k] = '_fit'
+        if 'eofs' in self.data:
+            # Dropped once unpacked, see _set_eofs
+            products['packed_eofs'] = '_set_packed_eofs'
+        products['eofs'] = '_set_eofs'
+        if self.metadata.get('wavelength', {}) is not False:
+            for k in ('dx_eof_phase', 'dy_eof_phase', 'L_x', 'L_y', 'c_x',
+                    'c_y', 'pc_frequency'):
+                products[k] = '_set_wavelenght'
+        if 'figs' in self.metadata:
+            products['figures'] = '_set_figures'
+        return products
 
+    def __missing__(self, key):
+        products = self.products()
+        if key not in products:
+            raise KeyError(key)
+        with limit_threads(self.n_workers):
+            getattr(self, products[key])()
+        return self.data[key]
 
-        from shapely.geometry import Polygon
-        from shapely.geometry import Point
-        polygon = Polygon(polygon_coordinates)
+    def __contains__(self, key):
+        return (key in self.data) or (key in self.products())
 
-        ind = ind&tmp
-        return ind
+    def __iter__(self):
+        return iter(self.keys())
 
+    def __len__(self):
+        return len(self.keys())
 
+    def keys(self):
+        return list(self.data.keys()) + \
+                [k for k in self.products() if k not in self.data]
 
-    def set_wavelenght(self):
-        """ Estimate the wavelenghts from the gradient of the EOF
-
+    def save(self, path, keys=None):
+        """ Save the results on the directory path, see store.save()
 
-	"""
-
-        eof_phase=numpy.arctan2(self['eofs'].imag, self['eofs'].real)
+            Use store.load(path) to load them back lazily.
+        """
+        store.save(self, path, keys)
+        return
 
-        eof_phase_360 = eof_phase.copy()
-        eof_phase_360[eof_phase<0] = 2*numpy.pi+eof_phase[eof_phase<0]
+    def filter(self,var,l,type,l2=None):
+        """ Filter var in time, see filters.prefilter()
+        """
+        output, halfpower_period = prefilter(self.data[var],
+                self.data['datetime'], l, type, l2, n_workers=self.n_workers)
+        self.halfpower_period = halfpower_period
+        self.data[var]=output
 
-        from fluid.common.common import _diff_centred
-        dx_eof_phase = _diff_centred(eof_phase,dim=1)
-        dx_eof_phase_360 = _diff_centred(eof_phase_360, dim=1)
+        return
 
-        ind = abs(dx_eof_phase)>abs(dx_eof_phase_360)
-        dx_eof_phase[ind] = dx_eof_phase_360[ind]
+    def select_data(self, var, polygon_coordinates=None, min_valid=1):
+        """ Mask of the grid points to be used in the CEOF
 
-	self.data['dx_eof_phase'] = dx_eof_phase
+            True where var has valid values on at least a fraction
+              min_valid of the times, all of them by default, and, if given,
+              inside polygon_coordinates, which can be a list of (lon, lat)
+              vertices, a (shell, holes) tuple, a shapely geometry, or a
+              list of those for multiple polygons (see regions module).
+        """
+        mask = ma.getmask(self.data[var])
+        if mask is ma.nomask:
+            ind = np.ones(self.data[var].shape[1:], dtype=bool)
+        else:
+            shape = mask.shape
+            mask = mask.reshape(shape[0], -1)
+            ind = np.empty(mask.shape[1], dtype=bool)
+            nvalid = max(1, int(np.ceil(min_valid * shape[0])))
+
+            def valid(cols):
+                ind[cols] = shape[0] - mask[:, cols].sum(axis=0) >= nvalid
+
+            N = mask.shape[1]
+            map_blocks(valid, N, split_blocksize(N, N, self.n_workers),
+                    self.n_workers)
+            ind = ind.reshape(shape[1:])
+
+        if polygon_coordinates is not None:
+            ind &= polygon_mask(self['Lon'], self['Lat'],
+                    polygon_coordinates)
+        return ind
 
-        #from scipy.interpolate import bisplrep, bisplev
-        #tck = bisplrep(x['Lon'], x['Lat'], eof_phase)
-        #dx_eof_phase_spline = bisplev(x['Lon'][0,:], x['Lat'][:,0],tck,dx=1)#/self.data['dX']
 
-        from fluid.common.common import lonlat2dxdy
-        #dX, dY = lonlat2dxdy( x['Lon'][0,:], self['Lat'][:,0])
-        dX, dY = lonlat2dxdy( self['lon'], self['lat'])
 
-        L_x = ma.masked_all(dx_eof_phase.shape)
-	for n in range(dx_eof_phase.shape[-1]):
-	    L_x[:,:,n] = dX/dx_eof_phase[:,:,n]*2*numpy.pi*1e-3
+    def set_wavelenght(self, nmodes=None):
+        """ Estimate the wavelenghts from the gradient of the EOF
 
-        #self.data['L_x'] = dX/dx_eof_phase*2*numpy.pi*1e-3
-        self.data['L_x'] = L_x
+            L_x, L_y, the phase speeds c_x, c_y and the pc_frequency of the
+              first nmodes modes (all if None), see wavelength.wavelength().
+              The speeds are in m/s if there is a datetime.
+        """
+        dt = None
+        if 'datetime' in self.data and len(self.data['datetime']) > 1:
+            t = self.data['datetime']
+            try:
+                dt = (t[-1] - t[0]).total_seconds() / (len(t) - 1)
+            except AttributeError:
+                pass
+
+        output = wavelength(self['eofs'], self['pcs'], self['lon'],
+                self['lat'], dt=dt, nmodes=nmodes, n_workers=self.n_workers)
+        self.data.update(output)
+        return
 
+    def eof(self, n):
+        """ Gridded EOF (J, K) of the mode n
 
-        #from fluid.common.common import _diff_centred
-        #eof_phase=numpy.arctan2(x['eofs'].imag,x['eofs'].real)
-        #deof_x=_diff_centred(eof_phase,dim=1)
-        #pylab.contourf(eof_phase[:,:,0])
-        #pylab.figure()
-        #pylab.contourf(deof_x[:,:,0],numpy.linspace(-0.5,0.5,20))
-        #pylab.colorbar()
-        #pylab.show()
+            Taken from the eofs if already unpacked, otherwise only this
+              mode is unpacked, and kept for the next calls.
+        """
+        if 'eofs' in self.data:
+            return self.data['eofs'][..., n]
+        if n not in self._modes:
+            self._modes[n] = unpack(self['packed_eofs'][:, n], self._index,
+                    self._shape)
+        return self._modes[n]
+
+    def reconstruct(self, nmodes=None, modes=None):
+        """ Field (T, J, K) reconstructed from the modes
+
+            See utils.ceof_reconstruct() for nmodes and modes. It is
+              estimated from the packed eofs, masked out of the points used,
+              and kept for the next calls with the same modes.
+        """
+        key = (nmodes, None if modes is None else tuple(modes))
+        if key not in self._reconstructions:
+            if modes is None:
+                modes = range(len(self['lambdas']) if nmodes is None
+                        else nmodes)
+            modes = list(modes)
+            with limit_threads(self.n_workers):
+                field = ceof_reconstruct(self._packed_eofs(modes),
+                        self['pcs'][:, modes])
+            output = ma.masked_all((len(field),) + self._shape,
+                    dtype=field.dtype)
+            output.reshape(len(field), -1)[:, self._index] = field
+            self._reconstructions[key] = output
+        return self._reconstructions[key]
+
+    def transform(self, data):
+        """ PCs (T', nmodes) of a new field data (T', J, K) on the modes
+
+            The analytic signal of data on the points of the fit
+              (grid_index) is projected on the packed eofs, in the
+              normalization of the fit, see utils.ceof_transform(). The
+              projection matrix is kept, so each call costs one Hilbert
+              transform and one (T', N) x (N, nmodes) matrix product, like
+              for consecutive windows of a stream. data can also be the
+              packed analytic signal (T', N).
+        """
+        if self._projection is None:
+            self._projection = eof_projection(self._packed_eofs())
+        index = None
+        if data.ndim == 3:
+            assert data.shape[1:] == self._shape, \
+                "transform requires a field on the grid %s x %s" % self._shape
+            index = self._index
+        with limit_threads(self.n_workers):
+            return ceof_transform(data, self._projection, index=index,
+                    dtype=self.metadata['ceof'].get('dtype'),
+                    n_workers=self.n_workers)
 
+    def go(self):
+        """ Evaluate all the products at once
+        """
+        for k in self.products():
+            self[k]
         return
 
+    def _set_grid(self):
+        with self.profiler.stage('grid'):
+            self.data['Lon'], self.data['Lat'] = numpy.meshgrid(self.data['lon'],self.data['lat'])
 
-    def go(self):
+    def _fit(self):
         var = self.metadata['ceof']['var']
+        stage = self.profiler.stage
 
-        if ('Lat' not in list(self.keys())) or ('Lon' not in list(self.keys())):
-            self.data['Lon'], self.data['Lat'] = numpy.meshgrid(self.data['lon'],self.data['lat'])
         if 'prefilter' in self.metadata:
-            print("Filtering in time")
-            if self.metadata['prefilter']['type'] == 'bandpass':
-                self.filter(var,l=self.metadata['prefilter']['l'],type=self.metadata['prefilter']['type'], l2=self.metadata['prefilter']['l2'],)
-            else:
-                self.filter(var,l=self.metadata['prefilter']['l'],type=self.metadata['prefilter']['type'])
+            self.logger.info("Filtering in time")
+            with stage('prefilter'):
+                if self.metadata['prefilter']['type'] == 'bandpass':
+                    self.filter(var,l=self.metadata['prefilter']['l'],type=self.metadata['prefilter']['type'], l2=self.metadata['prefilter']['l2'],)
+                else:
+                    self.filter(var,l=self.metadata['prefilter']['l'],type=self.metadata['prefilter']['type'])
         # ---- Normalize -----------------------------------------------------
         #self.data['ssh']=self.data['ssh']-self.data['ssh'].mean()
         # --------------------------------------------------------------------
-        ind = ma.getmaskarray(self.data[var]).any(axis=0) == False
+        cfg = self.metadata['ceof']
+        with stage('masking'):
+            ind = self.select_data(var, self.metadata.get('ceof_coord'),
+                    cfg.get('min_valid', 0.5 if cfg.get('gappy') else 1))
 
         I, J, K = self.data[var].shape
     
-        if 'ceof_coord' in self.metadata:
-            coord = self.metadata['ceof_coord']
-            assert type(coord) == list
-            from shapely.geometry import Point, Polygon
-            polygon = Polygon(coord)
-            for j in range(J):
-                for k in range(K):
-                        ind[j,k] = ind[j,k] & polygon.intersects(
-                                Point(self.data['Lon'][j,k],
-                                    self.data['Lat'][j,k]))
-  
-        #ind = ind&tmp
-    
-        N = int((numpy.ones(ind.shape)[ind]).sum())
-        grid_index = ma.masked_all((N,2), dtype='i')
-        n = -1
-        for j in range(J):
-            for k in range(K):
-                if ind[j, k]:
-                    n += 1
-                    grid_index[n, :] = [j, k]
-    
-        self.grid_index = grid_index
-        data2D = numpy.zeros((I,N), dtype=self.data[var].dtype)
-        for n, ind in enumerate(self.grid_index):
-            data2D[:, n] = self.data[var][:,ind[0], ind[1]]
-
-        print("Running CEOF_2D()")
-        output = CEOF_2D(data2D, cfg=self.metadata['ceof'])
-
-        nmodes = len(output['lambdas'])
-
-        for k in [k for k in list(output.keys()) if k is not 'ceof']:
+        index = numpy.flatnonzero(ind)
+        self.grid_index = numpy.argwhere(ind)
+        self._index = index
+        self._shape = (J, K)
+        self.logger.info("Running CEOF_2D()")
+        if cfg.get('gappy'):
+            # The analytic signal is estimated at each iteration of the
+            #   filling of the gaps, from the packed field
+            with stage('packing'):
+                U = ma.masked_array(pack(self.data[var], index))
+            with stage('decomposition'):
+                output = CEOF_2D(U, cfg=cfg)
+            del U
+        else:
+            # Looked up in cfg['cache'] by the field and index, so a hit
+            #   doesn't build the analytic signal
+            output = ceof_output(_decomposition(ma.getdata(self.data[var]),
+                cfg, index=index, n_workers=self.n_workers, stage=stage),
+                cfg)
+
+        self.data['packed_eofs'] = output.pop('eofs')
+        for k in [k for k in list(output.keys()) if k != 'ceof']:
             self.data[k] = output[k]
 
-        self.data['eofs'] = ma.masked_all((J, K, nmodes), dtype='complex128')
-        for n,ind in enumerate(self.grid_index):
-            self.data['eofs'][ind[0],ind[1],:] = output['eofs'][n,:]
+    def _set_eofs(self):
+        with self.profiler.stage('unpack'):
+            self.data['eofs'] = unpack(self['packed_eofs'], self._index,
+                    self._shape)
+        if not self.lazy:
+            # Not to keep the eofs twice, they are repacked when needed
+            del self.data['packed_eofs']
 
-	# ----
-	self.set_wavelenght()
+    def _set_packed_eofs(self):
+        self.data['packed_eofs'] = self._packed_eofs()
 
-        #for k in self.data.keys():
-        #    print k, self.data[k].shape, type(self.data[k])
+    def _packed_eofs(self, modes=None):
+        """ Packed eofs (N, nmodes), or only the columns modes
 
-        if 'figs' in self.metadata:
-	    print("Creating figures for %s modes" % nmodes)
-            #for nmode in range(5):
-            #for n in range(10):
-            for n in range(nmodes):
-                #eof2D=ceof['eofs'][:,nmode]
-                #pc2D=ceof['pcs'][:,nmode]
-                ##
-                ##eof=ma.masked_all(self.data['ssh'].shape[1:],dtype=eofs.dtype)
-                #eof=ma.masked_all(self.data['ssh'].shape[1:],dtype='complex128')
-                ##pc=ma.masked_all(self.data['ssh'].shape[1:],dtype=pcs.dtype)
-                #pc=ma.masked_all(self.data['ssh'].shape[1:],dtype='complex128')
-                ##
-                ##for n,i in enumerate(ind):
-                ##
-                ## ---- 2D back to grid ----
-                #for n,ind in enumerate(self.data2D['grid_index']):
-                #    #print n,ind
-                #    eof[ind[0],ind[1]] = eof2D[n]
-                #    #pc[ind[0],ind[1]] = pc2D[n]
-                #pc = pc2D
-                #print pc2D.shape
-                #varfrac = round(getvariancefraction(lambdas)[nmode]*1e2)
-                #varfrac = ceof['variancefraction'][nmode]
-                #fig = self.plot(eof_amp,eof_phase,pc_amp,pc_phase,nmode,varfrac)
-                if 'suffix' in self.metadata['figs']:
-                    filename="../figs/CEOF_%s_mode%s.eps" % (self.metadata['figs']['suffix'],(n+1))
-                else:
-                    filename="../figs/CEOF_mode%s.eps" % (n+1)
-                limits={'LatIni':-5, 'LatFin':15, 'LonIni':-60, 'LonFin':-25}
-                #self.plot(self['eofs'][:,:,n],self['pcs'][:,n],(n+1),self['variancefraction'][n],filename=filename,limits=limits,cumvarfrac=self['variancefraction'][:(n+1)].sum())
-                import graphics
-                graphics.plot(self['eofs'][:,:,n], self['pcs'][:,n],
-                        (n+1),self['variancefraction'][n],
-                        filename=filename,
-                        data = self.data,
-                        limits=limits,
-                        cumvarfrac=self['variancefraction'][:(n+1)].sum())
-                #fig.show()
-
-                #import pylab
-                #pylab.savefig("../fig/CEOF_mode%s.eps" % nmode)
-                ##print "dir(fig)",dir(fig)
-                ##fig.close()
-                #pylab.close()
+            Repacked from the eofs, a mode at a time, if they were dropped.
+        """
+        if ('packed_eofs' in self.data) or ('eofs' not in self.data):
+            packed = self['packed_eofs']
+            return packed if modes is None else packed[:, modes]
+        eofs = ma.getdata(self.data['eofs'])
+        if modes is None:
+            modes = range(eofs.shape[-1])
+        modes = list(modes)
+        packed = numpy.empty((len(self._index), len(modes)), dtype=eofs.dtype)
+        for i, n in enumerate(modes):
+            packed[:, i] = pack(eofs[..., n], self._index)
+        return packed
+
+    def _set_wavelenght(self):
+        cfg = self.metadata.get('wavelength', {})
+        with self.profiler.stage('wavelength'):
+            self.set_wavelenght(cfg.get('nmodes'))
+
+    def _set_figures(self):
+        cfg = self.metadata['figs']
+        nmodes = len(self['lambdas'])
+        nfigs = min(nmodes, cfg.get('nmodes', nmodes))
+        self.logger.info("Creating figures for %s modes", nfigs)
+        limits = cfg.get('limits',
+                {'LatIni':-5, 'LatFin':15, 'LonIni':-60, 'LonFin':-25})
+        import graphics
+        with self.profiler.stage('figures'):
+            self.data['figures'] = graphics.plot_modes(self['eofs'],
+                    self['pcs'], self['variancefraction'], self.data,
+                    outputdir=cfg.get('outputdir', '../figs'),
+                    suffix=cfg.get('suffix'),
+                    nmodes=nfigs,
+                    limits=limits,
+                    n_workers=cfg.get('n_workers', self.n_workers))
 
 
 
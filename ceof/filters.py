@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Time filters applied to the field before the CEOF
+
+    The filters are Hann weighted moving averages along time, applied to
+      blocks of columns by FFT convolution. Masked and non finite samples
+      are handled by normalized convolution, i.e. the average is over the
+      valid samples of each window only, which also takes care of the
+      edges of the series.
+"""
+
+import logging
+
+import numpy as np
+from numpy import ma
+
+try:
+    from scipy.fft import rfft, irfft, next_fast_len
+except ImportError:
+    from numpy.fft import rfft, irfft
+    next_fast_len = None
+
+from utils import HILBERT_BLOCK_ELEMENTS
+from workers import map_blocks, split_blocksize
+
+
+logger = logging.getLogger('ceof.filters')
+
+
+def hann_window(h):
+    """ Hann weights of half width h samples, centered, with odd length
+    """
+    m = int(np.floor(h))
+    r = np.arange(-m, m+1)
+    return 0.5 * (1 + np.cos(np.pi * r / float(h)))
+
+
+def _kernel_response(w, nfft):
+    """ rfft of the centered weights w, wrapped around the origin
+    """
+    m = len(w) // 2
+    k = np.zeros(nfft)
+    k[:m+1] = w[m:]
+    if m > 0:
+        k[-m:] = w[:m]
+    return rfft(k)
+
+
+def hann_filter(field, h, type='lowpass', h2=None, blocksize=None,
+        n_workers=None):
+    """ Filter field in time (axis 0) with Hann windows of half width h
+
+        type can be lowpass, highpass (field - lowpass) or bandpass, which
+          is the lowpass of half width h minus its smoothing by the half
+          width h2. The widths are in samples. The bandpass is done with the
+          combined window of the cascade, so it matches filtering twice
+          except within h + h2 samples of the gaps and edges, where the
+          combined window is the one normalized.
+
+        The spatial dimensions are processed in blocks of blocksize
+          columns, where each block costs one forward FFT of the data and
+          of its valid samples, in a pool of n_workers threads if given.
+          The output is masked where the input was masked or non finite,
+          or where a window has no valid samples.
+    """
+    if type not in ('lowpass', 'highpass', 'bandpass'):
+        raise ValueError("Filter type must be lowpass, highpass or "
+                "bandpass, got: %s" % type)
+    if type == 'bandpass' and h2 is None:
+        raise ValueError("A bandpass filter requires h2")
+
+    T = field.shape[0]
+    x = ma.getdata(field).reshape(T, -1)
+    valid = ~ma.getmaskarray(field).reshape(T, -1)
+    N = x.shape[1]
+    dtype = np.result_type(x.dtype, np.float32)
+
+    w = hann_window(h)
+    if type == 'bandpass':
+        w2 = np.convolve(w, hann_window(h2))
+    else:
+        w2 = w
+    nfft = T + len(w2) - 1
+    if next_fast_len is not None:
+        nfft = next_fast_len(nfft, True)
+    ctype = np.result_type(dtype, np.complex64)
+    K = _kernel_response(w, nfft).astype(ctype)
+    if type == 'bandpass':
+        K2 = _kernel_response(w2, nfft).astype(ctype)
+
+    if blocksize is None:
+        blocksize = max(1, HILBERT_BLOCK_ELEMENTS // nfft)
+    blocksize = split_blocksize(N, blocksize, n_workers)
+
+    output = np.empty((T, N), dtype=dtype)
+    mask = np.empty((T, N), dtype=bool)
+
+    def filter_block(cols):
+        block = np.array(x[:, cols], dtype=dtype)
+        v = valid[:, cols] & np.isfinite(block)
+        block[~v] = 0
+
+        X = rfft(block, nfft, axis=0)
+        V = rfft(v.astype(dtype), nfft, axis=0)
+
+        num = irfft(X * K[:, None], nfft, axis=0)[:T]
+        den = irfft(V * K[:, None], nfft, axis=0)[:T]
+        invalid = den <= 1e-8 * w.sum()
+        den[invalid] = 1
+        lowpass = num / den
+
+        if type == 'lowpass':
+            output[:, cols] = lowpass
+        elif type == 'highpass':
+            output[:, cols] = block - lowpass
+        else:
+            num = irfft(X * K2[:, None], nfft, axis=0)[:T]
+            den = irfft(V * K2[:, None], nfft, axis=0)[:T]
+            ind = den <= 1e-8 * w2.sum()
+            den[ind] = 1
+            invalid |= ind
+            output[:, cols] = lowpass - num / den
+        mask[:, cols] = invalid | ~v
+
+    map_blocks(filter_block, N, blocksize, n_workers)
+    return ma.masked_array(output.reshape(field.shape),
+            mask=mask.reshape(field.shape))
+
+
+def gain_spectrum(field, output, blocksize=None):
+    """ Median power gain of the filter output/field, by frequency
+
+        The power spectra of field and output are estimated, after
+          removing the mean, by a batched rfft on blocks of columns, for all
+          the grid points with no masked or non finite values. Their ratio is
+          the power gain of each point, and the median across space is a
+          robust estimate of the gain of the filter.
+
+        Returns the frequencies, in cycles per sample, and the median gain.
+    """
+    T = field.shape[0]
+    x = ma.getdata(field).reshape(T, -1)
+    y = ma.getdata(output).reshape(T, -1)
+    valid = ~(ma.getmaskarray(field).reshape(T, -1).any(axis=0) |
+            ma.getmaskarray(output).reshape(T, -1).any(axis=0))
+    valid &= np.isfinite(x).all(axis=0) & np.isfinite(y).all(axis=0)
+    index = np.flatnonzero(valid)
+
+    nf = T // 2 + 1
+    if blocksize is None:
+        blocksize = max(1, HILBERT_BLOCK_ELEMENTS // T)
+
+    gain = np.empty((nf, index.size), dtype='float32')
+    for n in range(0, index.size, blocksize):
+        cols = index[n:n+blocksize]
+        X = rfft(x[:, cols] - x[:, cols].mean(axis=0), axis=0)
+        Y = rfft(y[:, cols] - y[:, cols].mean(axis=0), axis=0)
+        P = X.real**2 + X.imag**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain[:, n:n+blocksize] = (Y.real**2 + Y.imag**2) / P
+        gain[:, n:n+blocksize][P == 0] = np.nan
+
+    freq = np.arange(nf) / float(T)
+    if index.size == 0:
+        return freq, np.nan * np.ones(nf)
+    with np.errstate(invalid='ignore'):
+        return freq, np.nanmedian(gain, axis=1)
+
+
+def halfpower_period(field, output, dt=1., type=None):
+    """ Period(s) where the power gain of the filter crosses one half
+
+        The crossings of the median gain, see gain_spectrum(), are linearly
+          interpolated in frequency. dt is the time step, so the periods
+          are in the units of dt.
+
+        For a lowpass or highpass type, returns the period of the crossing
+          at the lowest frequency. For a bandpass, returns a tuple (long,
+          short) of the first two crossings, with None for a side that
+          doesn't cross within the record. If type is None, it is a
+          bandpass if the gain starts below one half and crosses it again.
+          None if the gain never crosses one half.
+    """
+    freq, gain = gain_spectrum(field, output)
+    freq, gain = freq[1:], gain[1:]
+    ind = np.isfinite(gain)
+    freq, gain = freq[ind], gain[ind]
+
+    d = gain - 0.5
+    k = np.flatnonzero(np.sign(d[:-1]) * np.sign(d[1:]) < 0)
+    if k.size == 0:
+        return None
+    fc = freq[k] + (0.5 - gain[k]) * (freq[k+1] - freq[k]) / \
+            (gain[k+1] - gain[k])
+    periods = [float(p) for p in dt / fc]
+
+    if type is None:
+        type = 'bandpass' if (gain[0] < 0.5) and (k.size > 1) else 'lowpass'
+    if type != 'bandpass':
+        return periods[0]
+    if gain[0] > 0.5:
+        # The long period side is beyond the record
+        periods.insert(0, None)
+    return tuple((periods + [None])[:2])
+
+
+def prefilter(field, datetime, l, type, l2=None, n_workers=None):
+    """ Filter field (T, I, J) in time with a Hann window of size l
+
+        l (and l2 for bandpass) are timedelta, and the Hann windows have
+          half width l/2 (l2/2) samples of the regular time axis datetime.
+          See hann_filter() and workers for n_workers.
+
+        Returns the filtered field and its half power period in days, see
+          halfpower_period().
+    """
+    steps = set(np.diff(datetime))
+    if len(steps) != 1:
+        raise ValueError("Can't filter a non regular time series")
+
+    dt = steps.pop()
+    tscale = dt.days + dt.seconds/86400.
+    ll = (l.days + l.seconds/86400.) / tscale
+    if ll < 1:
+        raise ValueError("A filter of %s has no effect on a time series "
+                "with steps of %s" % (l, dt))
+
+    if type == 'bandpass':
+        ll2 = (l2.days + l2.seconds/86400.) / tscale
+        output = hann_filter(field, ll/2., type, ll2/2.,
+                n_workers=n_workers)
+    else:
+        output = hann_filter(field, ll/2., type, n_workers=n_workers)
+
+    period = halfpower_period(field, output, dt=tscale, type=type)
+    logger.info("Filter half window size: %s", l)
+    logger.info("Half Power Period: %s days", period)
+
+    return output, period
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CEOF of gappy data, filled iteratively by its own leading modes
+
+    In the style of DINEOF (Beckers & Rixen 2003), the gaps of a (T, N)
+      field are first filled with the temporal mean of each point, and then
+      repeatedly with Re(pcs eofs^T), the reconstruction by the leading
+      nmodes complex modes of the analytic signal of the filled field.
+      A random set of valid values is held out as gaps, and the iterations
+      stop when the error on them (cross-validation) stops decreasing.
+
+    Each iteration is a randomized SVD warm started from the eofs of the
+      previous one (see solvers.svd_randomized), so a single power
+      iteration is enough. The solution, the filled values and the eofs,
+      is kept by decompose_gappy() for the same data and held out set, so
+      a rerun with more modes starts from it.
+"""
+
+from collections import OrderedDict
+import logging
+
+import numpy as np
+from numpy import ma
+
+from utils import analytic_signal
+from solvers import svd_randomized
+from cache import fingerprint
+
+
+logger = logging.getLogger('ceof.gappy')
+
+# Number of solutions kept by decompose_gappy()
+MAX_SOLUTIONS = 4
+
+_solutions = OrderedDict()
+
+
+def fill_gaps(data, nmodes, start=None, cv_fraction=0.03, tol=1e-3,
+        maxiter=100, power_iterations=1, oversampling=10, seed=0,
+        dtype=None, n_workers=None):
+    """ Decomposition of the gappy data (T, N), filled by its modes
+
+        data is a masked array, where the masked values are the gaps, with
+          valid values at each point. A fraction cv_fraction of the valid
+          values, chosen at random by seed, is held out. The iterations stop
+          when the rms error on those decreases by less than tol, relative,
+          or increases, or after maxiter. Then the fill of the lowest error
+          is taken, with the held out values restored, for a last
+          decomposition.
+
+        start is a previous solution of the same data and held out set,
+          like with fewer modes, to start from instead of the means.
+
+        Returns (pcs, lambdas, eofs, totalvar) of the filled field, as the
+          solvers do, and the solution, a dict with the 'fill' of the gaps
+          and held out values, 'eofs', 'nmodes' and 'cv_error', the error
+          of each iteration.
+    """
+    T, N = data.shape
+    gaps = ma.getmaskarray(data)
+    if dtype is None:
+        dtype = np.result_type(data.dtype, np.float32)
+    X = np.array(ma.getdata(data), dtype=dtype)
+    nvalid = T - gaps.sum(axis=0)
+    assert nvalid.all(), "fill_gaps requires valid values at every point"
+
+    rng = np.random.RandomState(seed)
+    valid = np.flatnonzero(~gaps)
+    cv = rng.choice(valid, int(cv_fraction * valid.size), replace=False)
+    assert cv.size > 0, "cv_fraction leaves no values to cross-validate"
+    truth = X.flat[cv]
+    missing = gaps.copy()
+    missing.flat[cv] = True
+
+    if start is None:
+        # The mean of the values kept, without the held out ones
+        X[missing] = 0
+        mean = X.sum(axis=0) / np.maximum(1, T - missing.sum(axis=0))
+        X[missing] = np.broadcast_to(mean, X.shape)[missing]
+        initial = None
+    else:
+        assert start['fill'].size == missing.sum(), \
+            "start is not a solution of this data"
+        X[missing] = start['fill']
+        initial = start['eofs'].conj()
+
+    def decompose(X, initial):
+        U = analytic_signal(X, n_workers=n_workers)
+        return svd_randomized(U, nmodes, oversampling,
+                power_iterations if initial is not None else 2,
+                seed=seed, initial=initial)
+
+    errors = []
+    best = None
+    for i in range(maxiter):
+        pcs, lambdas, eofs, totalvar = decompose(X, initial)
+        initial = eofs.conj()
+        # Re(pcs eofs^T), without the complex product
+        R = pcs.real.dot(eofs.real.T) - pcs.imag.dot(eofs.imag.T)
+        X[missing] = R[missing]
+        del R
+        errors.append(np.sqrt(((X.flat[cv] - truth)**2).mean()))
+        logger.debug("Iteration %s, cross-validation error %s", i + 1,
+                errors[-1])
+        if (best is None) or (errors[-1] < errors[best[0]]):
+            best = (i, X[missing], eofs)
+        if (i > 0) and (errors[-2] - errors[-1] < tol * errors[-2]):
+            break
+
+    # The fill of the lowest error, the last one unless it went up
+    i, fill, eofs = best
+    logger.info("Gaps filled with %s modes, cross-validation error %s at "
+            "iteration %s of %s", nmodes, errors[i], i + 1, len(errors))
+    solution = {'fill': fill, 'eofs': eofs, 'nmodes': nmodes,
+            'cv_error': np.array(errors)}
+
+    X[missing] = fill
+    X.flat[cv] = truth
+    initial = eofs.conj()
+    result = decompose(X, initial)
+    return result, solution
+
+
+def decompose_gappy(data, nmodes, cv_fraction=0.03, seed=0, dtype=None,
+        **keywords):
+    """ fill_gaps() of data, starting from its last solution if any
+
+        The solutions of the last MAX_SOLUTIONS data are kept by the
+          fingerprint of data and its mask, with cv_fraction, seed and
+          dtype, which set the held out values. A rerun with the same
+          nmodes and the same options of fill_gaps() (tol, maxiter...)
+          returns the kept result, otherwise it starts from it, like with
+          more modes or a tighter tol.
+    """
+    key = (fingerprint(ma.getdata(data)), fingerprint(ma.getmaskarray(data)),
+            cv_fraction, seed, None if dtype is None else np.dtype(dtype).str)
+    # The threads don't change the solution
+    options = repr(sorted((k, v) for k, v in keywords.items()
+        if k != 'n_workers'))
+    start = _solutions.pop(key, None)
+    if (start is not None) and (start['nmodes'] == nmodes) and \
+            (start['options'] == options):
+        result = start['result']
+        solution = start
+    else:
+        result, solution = fill_gaps(data, nmodes, start=start,
+                cv_fraction=cv_fraction, seed=seed, dtype=dtype, **keywords)
+        solution['result'] = result
+        solution['options'] = options
+    _solutions[key] = solution
+    while len(_solutions) > MAX_SOLUTIONS:
+        _solutions.popitem(last=False)
+    return result
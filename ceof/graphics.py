@@ -1,28 +1,106 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+import logging
+import os
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
 import numpy as np
+from numpy import ma
 
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.basemap import Basemap
 
+from workers import get_n_workers
+
+
+logger = logging.getLogger('ceof.graphics')
+
+# Maximum number of MapProjection kept by get_projection()
+PROJECTION_CACHE_SIZE = 8
+
+_projections = OrderedDict()
+
+
+class MapProjection(object):
+    """ Basemap and projected grid X, Y of one domain and lon/lat grid
+
+        Building a Basemap (coastlines) and projecting the grid is the
+          dominant cost of a panel, so one instance is shared across the
+          panels, modes and frames of the same domain. Use get_projection()
+          to get the cached instance.
+    """
+    parallels = np.arange(-5,20.1,5)
+    meridians = np.arange(300,340,10)
+
+    def __init__(self, lon, lat, limits):
+        self.basemap = Basemap(projection='merc', lat_ts=0,
+                llcrnrlon=limits['LonIni'], llcrnrlat=limits['LatIni'],
+                urcrnrlon=limits['LonFin'], urcrnrlat=limits['LatFin'],
+                resolution='l', area_thresh=1000.)
+        self.X, self.Y = self.basemap(*np.meshgrid(lon, lat))
+
+    def contourf(self, field, *args, **kwargs):
+        return self.basemap.contourf(self.X, self.Y, field, *args, **kwargs)
+
+    def draw_background(self, ax=None):
+        """ Coastlines, continents, parallels and meridians on ax
+
+            On a figure that is kept alive, like on an animation, this is
+              drawn only once, with the data plotted below it (zorder < 1).
+        """
+        self.basemap.drawcoastlines(ax=ax)
+        self.basemap.fillcontinents(color='0.0', ax=ax)
+        self.basemap.drawparallels(self.parallels, labels=[1,0,0,1], ax=ax)
+        self.basemap.drawmeridians(self.meridians, labels=[1,0,0,1], ax=ax)
+
+
+def remove_contours(cs):
+    """ Remove a contour set from its axes
+    """
+    try:
+        cs.remove()
+    except (AttributeError, NotImplementedError):
+        # Older matplotlib, where ContourSet isn't an Artist
+        for c in cs.collections:
+            c.remove()
+
+
+def get_projection(lon, lat, limits=None):
+    """ Cached MapProjection for the domain limits and lon/lat grid
+
+        If limits is None, the domain is the extent of lon/lat. The last
+          PROJECTION_CACHE_SIZE projections used are kept.
+    """
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    if limits is None:
+        limits = {'LatIni': lat.min(), 'LatFin': lat.max(),
+                'LonIni': lon.min(), 'LonFin': lon.max()}
+
+    key = (tuple(sorted(limits.items())), lon.shape, lon.tobytes(),
+            lat.shape, lat.tobytes())
+    if key in _projections:
+        _projections[key] = _projections.pop(key)
+    else:
+        _projections[key] = MapProjection(lon, lat, limits)
+        while len(_projections) > PROJECTION_CACHE_SIZE:
+            _projections.popitem(last=False)
+    return _projections[key]
+
+
 def plot(eof, pc, nmode, varfrac, filename, data, limits=None, cumvarfrac=None):
     """ Plot one mode of the CEOF
     """
     import pylab
     import matplotlib
 
-    if limits == None:
-        #LatIni = self['Lat'].min()
-        #LatFin = self['Lat'].max()
-        #LonIni = self['Lon'].min()
-        #LonFin = self['Lon'].max()
-        pass
-    else:
-        LatIni = limits['LatIni']
-        LatFin = limits['LatFin']
-        LonIni = limits['LonIni']
-        LonFin = limits['LonFin']
+    proj = get_projection(data['lon'], data['lat'], limits)
 
     # ----
     cdict = {'red': ((0.0, 0.0, 0.0),
@@ -80,9 +158,6 @@ def plot(eof, pc, nmode, varfrac, filename, data, limits=None, cumvarfrac=None):
 
     # ----
 
-    parallels = np.arange(-5,20.1,5)
-    meridians = np.arange(300,340,10)
-
     margin=0.08
     left=margin
     bottom=margin
@@ -114,22 +189,13 @@ def plot(eof, pc, nmode, varfrac, filename, data, limits=None, cumvarfrac=None):
     fig.text(.5, .95, title, horizontalalignment='center',fontsize=16)
     #
     pylab.axes([left, bottom + 2*height_pc + 2*margin, width_eof, height_eof])
-    map = Basemap(projection='merc', lat_ts=0, llcrnrlon=LonIni,
-            llcrnrlat=LatIni, urcrnrlon=LonFin, urcrnrlat=LatFin,
-            resolution='l', area_thresh=1000.)
-    X, Y = list(map(*pylab.meshgrid(data['lon'], data['lat'])))
-    map.contourf(X, Y, eof_amp*1e2)
+    proj.contourf(eof_amp*1e2)
     pylab.title("CEOF amplitude")
     cbar = pylab.colorbar()
     cbar.set_label('[cm]')
-    map.drawcoastlines()
-    map.fillcontinents(color='0.0')
-    map.drawparallels(parallels,labels=[1,0,0,1])
-    map.drawmeridians(meridians,labels=[1,0,0,1])
+    proj.draw_background()
 
     pylab.axes([left+width_eof+margin, bottom + 2*height_pc + 2*margin, width_eof, height_eof])
-    map = Basemap(projection='merc',lat_ts=0,llcrnrlon=LonIni,llcrnrlat=LatIni, urcrnrlon=LonFin, urcrnrlat=LatFin,resolution='l',area_thresh=1000.)
-    X, Y = list(map(*pylab.meshgrid(data['lon'],data['lat'])))
     V=[-180, -150, -120, -90, -60, -30, 0, 30, 60, 90, 120, 150, 180]
     #V = range(-180,181,20)
     #import matplotlib.cm as cm
@@ -141,16 +207,13 @@ def plot(eof, pc, nmode, varfrac, filename, data, limits=None, cumvarfrac=None):
     from numpy import ma
     #ind_sig = eof_amp<0.01
     #eof_phase_deg = eof_phase*180/np.pi
-    map.contourf(X, Y, eof_phase*180/np.pi, V, cmap=grey_cmap)
-    map.contourf(X,Y,ma.masked_array(eof_phase*180/np.pi, mask=eof_amp<0.01),V,cmap=um_sym_cmap)
+    proj.contourf(eof_phase*180/np.pi, V, cmap=grey_cmap)
+    proj.contourf(ma.masked_array(eof_phase*180/np.pi, mask=eof_amp<0.01),V,cmap=um_sym_cmap)
 
     cbar = pylab.colorbar()
     cbar.set_label('[degrees]')
     pylab.title("CEOF phase")
-    map.drawcoastlines()
-    map.fillcontinents(color='0.0')
-    map.drawparallels(parallels,labels=[1,0,0,1])
-    map.drawmeridians(meridians,labels=[1,0,0,1])
+    proj.draw_background()
     # ----
     #pylab.subplot(2,2,2)
     pylab.axes([left, bottom+margin+height_pc, width_pc, height_pc])
@@ -177,7 +240,230 @@ def plot(eof, pc, nmode, varfrac, filename, data, limits=None, cumvarfrac=None):
     #pylab.grid()
     # ----
     #pylab.show()
-    print("Saving figure %s" % filename)
+    logger.info("Saving figure %s", filename)
     #fig.savefig(filename)
     pylab.savefig(filename)
     pylab.close()
+
+
+def _plot_mode(args):
+    """ Worker of plot_modes(), reading the mode n from the memmaps
+    """
+    eofsfile, maskfile, n, pc, varfrac, cumvarfrac, filename, coords, \
+            limits = args
+    eof = ma.masked_array(np.load(eofsfile, mmap_mode='r')[:, :, n],
+            mask=np.load(maskfile, mmap_mode='r')[:, :, n])
+    plot(eof, pc, (n+1), varfrac, filename=filename, data=coords,
+            limits=limits, cumvarfrac=cumvarfrac)
+
+
+def plot_modes(eofs, pcs, variancefraction, data, outputdir='../figs',
+        suffix=None, nmodes=None, limits=None, n_workers=None):
+    """ Plot the first nmodes modes, one figure per mode
+
+        The figures are saved in outputdir as CEOF_[suffix_]mode#.eps. With
+          n_workers, the figures are rendered by a pool of up to n_workers
+          processes, see workers.get_n_workers().
+          The gridded eofs are shared with the workers through temporary
+          memmaps, so each worker reads only its mode, and only lon, lat
+          and datetime of data are sent to them.
+
+        Returns the list of the filenames.
+    """
+    if nmodes is None:
+        nmodes = eofs.shape[-1]
+    nmodes = min(nmodes, eofs.shape[-1])
+
+    coords = dict((k, data[k]) for k in ('lon', 'lat', 'datetime'))
+    filenames = []
+    for n in range(nmodes):
+        if suffix is not None:
+            filename = "CEOF_%s_mode%s.eps" % (suffix, (n+1))
+        else:
+            filename = "CEOF_mode%s.eps" % (n+1)
+        filenames.append(os.path.join(outputdir, filename))
+    cumvarfrac = np.cumsum(variancefraction[:nmodes])
+
+    n_workers = min(get_n_workers(n_workers), nmodes)
+    if n_workers <= 1:
+        for n in range(nmodes):
+            plot(eofs[:, :, n], pcs[:, n], (n+1), variancefraction[n],
+                    filename=filenames[n], data=coords, limits=limits,
+                    cumvarfrac=cumvarfrac[n])
+        return filenames
+
+    tmpdir = tempfile.mkdtemp(prefix='ceof_figs_')
+    try:
+        eofsfile = os.path.join(tmpdir, 'eofs.npy')
+        maskfile = os.path.join(tmpdir, 'mask.npy')
+        np.save(eofsfile, ma.getdata(eofs[:, :, :nmodes]))
+        np.save(maskfile, ma.getmaskarray(eofs[:, :, :nmodes]))
+
+        tasks = [(eofsfile, maskfile, n, pcs[:, n], variancefraction[n],
+            cumvarfrac[n], filenames[n], coords, limits)
+            for n in range(nmodes)]
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            pool.map(_plot_mode, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+    return filenames
+
+
+class AnimationFrames(object):
+    """ Figure of the animation, kept alive along the frames
+
+        Two panels, the data and the EOF reconstructed field. The
+          background is drawn once, and on each frame only the contours
+          and the titles are updated. size is (width, height) in pixels.
+    """
+    V = list(range(-20, 21, 1))
+
+    def __init__(self, lat, lon, limits=None, size=(800, 600), dpi=100):
+        self.proj = get_projection(lon, lat, limits)
+        self.fig = plt.figure(figsize=(size[0]/float(dpi),
+            size[1]/float(dpi)), dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.axes = [self.fig.add_subplot(211), self.fig.add_subplot(212)]
+        self.titles = []
+        for ax in self.axes:
+            self.proj.draw_background(ax=ax)
+            self.titles.append(ax.set_title(''))
+        self.contours = [None, None]
+
+    def size(self):
+        return self.fig.canvas.get_width_height()
+
+    def draw(self, field, eoffield, date):
+        """ Update the figure and return the raw RGBA frame
+        """
+        for n, f in enumerate((field, eoffield)):
+            if self.contours[n] is None:
+                self.contours[n] = self.proj.contourf(f, self.V,
+                        ax=self.axes[n], zorder=0.5)
+                self.fig.colorbar(self.contours[n], ax=self.axes[n],
+                        shrink=0.8)
+            else:
+                remove_contours(self.contours[n])
+                self.contours[n] = self.proj.contourf(f, self.V,
+                        ax=self.axes[n], zorder=0.5)
+        self.titles[0].set_text('%s' % (date.strftime('%Y-%m-%d')))
+        self.titles[1].set_text('%s (EOF reconstructed)' %
+                (date.strftime('%Y-%m-%d')))
+        self.fig.canvas.draw()
+        return self.fig.canvas.buffer_rgba()
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def encoder_command(encoder, filename, size, fps):
+    """ Command line of encoder to read raw RGBA frames from stdin
+    """
+    w, h = size
+    if encoder == 'ffmpeg':
+        return ['ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                '-s', '%dx%d' % (w, h), '-r', '%s' % fps, '-i', '-',
+                '-an', '-vcodec', 'mpeg4', '-q:v', '2', filename]
+    elif encoder == 'mencoder':
+        return ['mencoder', '-', '-really-quiet',
+                '-demuxer', 'rawvideo',
+                '-rawvideo', 'w=%d:h=%d:fps=%s:format=rgba' % (w, h, fps),
+                '-ovc', 'lavc', '-lavcopts', 'vcodec=mpeg4',
+                '-o', filename]
+    assert False, "Unknown encoder: %s" % encoder
+
+
+def concat_command(encoder, filenames, outputfilename, tmpdir):
+    """ Command line of encoder to concatenate the segments filenames
+    """
+    if encoder == 'ffmpeg':
+        listfile = os.path.join(tmpdir, 'segments.txt')
+        with open(listfile, 'w') as f:
+            for filename in filenames:
+                f.write("file '%s'\n" % filename)
+        return ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat',
+                '-safe', '0', '-i', listfile, '-c', 'copy', outputfilename]
+    elif encoder == 'mencoder':
+        return ['mencoder', '-really-quiet', '-ovc', 'copy', '-oac', 'copy',
+                '-o', outputfilename] + list(filenames)
+    assert False, "Unknown encoder: %s" % encoder
+
+
+def encode_frames(data, eofdata, t, frames, lat, lon, outputfilename,
+        limits=None, fps=2, size=(800, 600), encoder='mencoder'):
+    """ Render frames of data/eofdata and pipe them to encoder
+    """
+    figure = AnimationFrames(lat, lon, limits, size)
+    proc = subprocess.Popen(
+            encoder_command(encoder, outputfilename, figure.size(), fps),
+            stdin=subprocess.PIPE)
+    try:
+        for i in frames:
+            proc.stdin.write(figure.draw(data[i], eofdata[i], t[i]))
+    finally:
+        proc.stdin.close()
+        figure.close()
+    assert proc.wait() == 0, "%s failed on %s" % (encoder, outputfilename)
+
+
+def _encode_segment(args):
+    """ Worker of write_animation(), reading the frames from the memmaps
+    """
+    datafile, eoffile = args[:2]
+    encode_frames(np.load(datafile, mmap_mode='r'),
+            np.load(eoffile, mmap_mode='r'), *args[2:])
+
+
+def write_animation(data, eofdata, t, lat, lon, outputfilename, limits=None,
+        fps=2, size=(800, 600), encoder='mencoder', n_workers=None):
+    """ Animation of data and eofdata (T, I, J), streamed to the encoder
+
+        The frames go straight to the encoder (ffmpeg or mencoder) through
+          a pipe, without intermediate images. With n_workers, the frames
+          are split in up to n_workers segments (see
+          workers.get_n_workers()), encoded in parallel by a pool of
+          processes reading data and eofdata from temporary memmaps, and
+          then concatenated.
+    """
+    T = len(t)
+    n_workers = min(get_n_workers(n_workers), T)
+    if n_workers <= 1:
+        encode_frames(data, eofdata, t, range(T), lat, lon, outputfilename,
+                limits, fps, size, encoder)
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix='ceof_anim_')
+    try:
+        datafile = os.path.join(tmpdir, 'data.npy')
+        eoffile = os.path.join(tmpdir, 'eofdata.npy')
+        np.save(datafile, ma.filled(ma.masked_array(data, dtype='f8'),
+            np.nan))
+        np.save(eoffile, ma.filled(ma.masked_array(eofdata, dtype='f8'),
+            np.nan))
+
+        ext = os.path.splitext(outputfilename)[1]
+        segments = []
+        tasks = []
+        for n, frames in enumerate(np.array_split(np.arange(T), n_workers)):
+            if len(frames) == 0:
+                continue
+            segments.append(os.path.join(tmpdir, 'segment%03d%s' % (n, ext)))
+            tasks.append((datafile, eoffile, t, list(frames), lat, lon,
+                segments[-1], limits, fps, size, encoder))
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            pool.map(_encode_segment, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        command = concat_command(encoder, segments, outputfilename, tmpdir)
+        assert subprocess.call(command) == 0, \
+                "Failed to concatenate the segments on %s" % outputfilename
+    finally:
+        shutil.rmtree(tmpdir)
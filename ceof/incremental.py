@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CEOF updated in place as new time steps arrive
+
+    The leading modes are kept as a rank nmodes model, eofs = conj(V),
+      lambdas = s**2/T and pcs = U V, and updated with the incremental SVD
+      of Brand (2006) when rows (time steps) are added, or downdated when
+      rows are dropped.
+
+    The Hilbert transform is not local in time, so appending samples
+      changes the analytic signal of the whole record. The policy here is
+      that the last cfg['trailing'] time steps are provisional: at each
+      update they are removed from the model and added again, together
+      with the new time steps, with the analytic signal recomputed on the
+      last cfg['hilbert_window'] samples. Older time steps are frozen.
+
+    The cost of an update depends on the number of new samples, trailing
+      and hilbert_window, not on the length of the record, apart from an
+      O(T*nmodes**2) rotation of the PCs.
+"""
+
+try:
+    from UserDict import UserDict
+except ImportError:
+    from collections import UserDict
+
+import numpy as np
+from scipy.linalg import eigh
+
+from utils import analytic_signal, scaleEOF
+from solvers import SOLVERS
+
+
+class CEOF_Incremental(UserDict):
+    """ Updatable CEOF of a 2D (T, N) field
+
+        cfg keys:
+          - maxnmodes: number of modes kept (required);
+          - window: sliding window length, None (default) for a growing
+              record;
+          - trailing: number of provisional time steps (default 30);
+          - hilbert_window: samples used for the Hilbert transform of the
+              updated time steps (default 4*trailing), at least trailing;
+          - solver: solver of the first decomposition (default gram);
+          - normalize: as in CEOF_2D, applied to the output only.
+
+        The results are available through the dict interface, as pcs,
+          eofs, lambdas and variancefraction.
+    """
+    def __init__(self, data, cfg):
+        UserDict.__init__(self)
+        assert data.ndim == 2, "CEOF_Incremental requires a 2D ndarray"
+        assert type(cfg) is dict, "cfg must be a dictionary"
+        assert 'maxnmodes' in cfg, "CEOF_Incremental requires maxnmodes"
+
+        self.cfg = cfg
+        self.nmodes = cfg['maxnmodes']
+        self.window = cfg.get('window')
+        self.trailing = cfg.get('trailing', 30)
+        self.hilbert_window = cfg.get('hilbert_window', 4 * self.trailing)
+        assert self.hilbert_window >= self.trailing, \
+                "hilbert_window must be at least trailing"
+        if self.window is not None:
+            assert self.window > self.trailing, \
+                    "window must be larger than trailing"
+
+        self.fit(data)
+        return
+
+    def fit(self, data):
+        """ Decompose data from scratch
+        """
+        assert np.isfinite(data).all(), \
+                "CEOF_Incremental requires a full valid values array"
+        if self.window is not None:
+            data = data[-self.window:]
+
+        U = analytic_signal(data)
+        solver = self.cfg.get('solver', 'gram')
+        pcs, lambdas, eofs, totalvar = SOLVERS[solver](U, self.nmodes)
+
+        T = U.shape[0]
+        self.V = eofs[:, :self.nmodes].conj()
+        self.s2 = lambdas[:self.nmodes] * T
+        self.pcs = pcs[:, :self.nmodes]
+        self.energy = (U.real**2 + U.imag**2).sum(axis=1)
+        self.buffer = np.array(data[-self.hilbert_window:])
+
+        self.set_output()
+        return
+
+    def update(self, new):
+        """ Append the time steps new, with shape (b, N)
+
+            The provisional time steps are recomputed, and with a sliding
+              window the oldest time steps are dropped.
+        """
+        new = np.atleast_2d(new)
+        assert new.shape[1] == self.V.shape[0], \
+                "Expected %s points, got %s" % (self.V.shape[0], new.shape[1])
+        assert np.isfinite(new).all(), \
+                "CEOF_Incremental requires a full valid values array"
+
+        b = new.shape[0]
+        ntrail = min(self.trailing, self.pcs.shape[0])
+
+        buffer = np.concatenate((self.buffer, new), axis=0)
+        B = analytic_signal(buffer)[-(ntrail + b):]
+        self.buffer = buffer[-self.hilbert_window:]
+
+        if ntrail > 0:
+            self._drop_rows(slice(-ntrail, None))
+        self._add_rows(B)
+
+        if self.window is not None and self.pcs.shape[0] > self.window:
+            self._drop_rows(slice(None, self.pcs.shape[0] - self.window))
+
+        self.set_output()
+        return
+
+    def _add_rows(self, B):
+        """ Rank nmodes update of the model with the complex rows B
+        """
+        k = self.nmodes
+        P = B.dot(self.V)
+        Q, R = np.linalg.qr(B.conj().T - self.V.dot(P.conj().T))
+
+        # C' = [V Q] K [V Q]^H
+        M = np.concatenate((P.conj().T, R), axis=0)
+        K = M.dot(M.conj().T)
+        K[np.arange(k), np.arange(k)] += self.s2
+        w, E = eigh(K)
+        w, E = w[::-1][:k], E[:, ::-1][:, :k]
+
+        self.V = self.V.dot(E[:k]) + Q.dot(E[k:])
+        self.s2 = np.clip(w, 0, None)
+        self.pcs = np.concatenate((self.pcs.dot(E[:k]),
+            np.concatenate((P, R.conj().T), axis=1).dot(E)), axis=0)
+        self.energy = np.concatenate((self.energy,
+            (B.real**2 + B.imag**2).sum(axis=1)))
+        return
+
+    def _drop_rows(self, rows):
+        """ Remove rows from the model, using their rank nmodes projection
+        """
+        P = self.pcs[rows]
+        K = np.diag(self.s2).astype(P.dtype) - P.conj().T.dot(P)
+        w, E = eigh(K)
+        w, E = w[::-1], E[:, ::-1]
+
+        keep = np.ones(self.pcs.shape[0], dtype=bool)
+        keep[rows] = False
+        self.V = self.V.dot(E)
+        self.s2 = np.clip(w, 0, None)
+        self.pcs = self.pcs[keep].dot(E)
+        self.energy = self.energy[keep]
+        return
+
+    def set_output(self):
+        """ Refresh pcs, eofs, lambdas and variancefraction
+        """
+        T = self.pcs.shape[0]
+        pcs = self.pcs.copy()
+        eofs = self.V.conj()
+        if 'normalize' in self.cfg:
+            pcs, eofs = scaleEOF(pcs, eofs, scaletype=self.cfg['normalize'])
+
+        self.data['pcs'] = pcs
+        self.data['eofs'] = eofs
+        self.data['lambdas'] = self.s2 / T
+        self.data['variancefraction'] = self.s2 / self.energy.sum()
+        return
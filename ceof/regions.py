@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Vectorized selection of the grid points inside polygons
+
+    A polygon can be given as:
+      - a list of (lon, lat) vertices;
+      - a tuple (shell, holes), where shell is a list of vertices and holes
+          a list of lists of vertices;
+      - a shapely Polygon or MultiPolygon;
+      - a list of any of the above, for multiple polygons.
+"""
+
+from collections import OrderedDict
+import hashlib
+
+import numpy as np
+
+
+# Maximum number of masks kept by polygon_mask()
+MASK_CACHE_SIZE = 64
+
+# Distance, in the units of the coordinates, of a point taken as on an edge
+EDGE_TOLERANCE = 1e-9
+
+_mask_cache = OrderedDict()
+
+
+def _ring(coords):
+    """ Vertices as a (n, 2) float array, or None if coords isn't a ring
+    """
+    try:
+        ring = np.asarray(coords, dtype='float64')
+    except (ValueError, TypeError):
+        return None
+    if ring.ndim == 2 and ring.shape[1] == 2:
+        return ring
+    return None
+
+
+def polygons_rings(polygons):
+    """ Standardize polygons as a list of (shell, [holes]) of (n, 2) arrays
+    """
+    if hasattr(polygons, 'geoms'):
+        return polygons_rings(list(polygons.geoms))
+    if hasattr(polygons, 'exterior'):
+        return [(np.asarray(polygons.exterior.coords, dtype='float64'),
+            [np.asarray(h.coords, dtype='float64')
+                for h in polygons.interiors])]
+
+    ring = _ring(polygons)
+    if ring is not None:
+        return [(ring, [])]
+
+    if isinstance(polygons, tuple) and len(polygons) == 2:
+        shell = _ring(polygons[0])
+        if shell is not None:
+            return [(shell, [_ring(h) for h in polygons[1]])]
+
+    output = []
+    for p in polygons:
+        output.extend(polygons_rings(p))
+    return output
+
+
+def _crossings(x, y, ring, inside):
+    """ Toggle inside for each edge of ring crossed by a ray from (x, y)
+    """
+    x1, y1 = ring[:, 0], ring[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    for n in range(len(ring)):
+        if y1[n] == y2[n]:
+            continue
+        ind = (y1[n] > y) != (y2[n] > y)
+        ind[ind] = x[ind] < (x2[n] - x1[n]) * (y[ind] - y1[n]) / \
+                (y2[n] - y1[n]) + x1[n]
+        inside ^= ind
+    return inside
+
+
+def _on_edges(x, y, ring, output):
+    """ Set output where (x, y) is on an edge of ring, within EDGE_TOLERANCE
+    """
+    x1, y1 = ring[:, 0], ring[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    for n in range(len(ring)):
+        length = np.hypot(x2[n] - x1[n], y2[n] - y1[n])
+        cross = (x2[n] - x1[n]) * (y - y1[n]) - (y2[n] - y1[n]) * (x - x1[n])
+        output |= (np.absolute(cross) <= EDGE_TOLERANCE * length) & \
+                (x >= min(x1[n], x2[n]) - EDGE_TOLERANCE) & \
+                (x <= max(x1[n], x2[n]) + EDGE_TOLERANCE) & \
+                (y >= min(y1[n], y2[n]) - EDGE_TOLERANCE) & \
+                (y <= max(y1[n], y2[n]) + EDGE_TOLERANCE)
+    return output
+
+
+def points_in_polygons(x, y, polygons):
+    """ Boolean array, True where the points (x, y) are inside polygons
+
+        Ray casting, vectorized on the points, after a bounding box
+          prefilter on each shell. Holes are handled by the even-odd
+          rule. Points on an edge, of the shell or of a hole, are
+          inside, as for shapely's polygon.intersects(Point).
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    output = np.zeros(x.shape, dtype=bool)
+    for shell, holes in polygons_rings(polygons):
+        bbox = (x >= shell[:, 0].min() - EDGE_TOLERANCE) & \
+                (x <= shell[:, 0].max() + EDGE_TOLERANCE) & \
+                (y >= shell[:, 1].min() - EDGE_TOLERANCE) & \
+                (y <= shell[:, 1].max() + EDGE_TOLERANCE)
+        xb, yb = x[bbox], y[bbox]
+        inside = np.zeros(xb.shape, dtype=bool)
+        for ring in [shell] + holes:
+            _crossings(xb, yb, ring, inside)
+        for ring in [shell] + holes:
+            _on_edges(xb, yb, ring, inside)
+        output[bbox] |= inside
+    return output
+
+
+def _key(*arrays):
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode('ascii'))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def polygon_mask(Lon, Lat, polygons):
+    """ Mask of the grid points (Lon, Lat) inside polygons
+
+        The masks are cached by polygons and grid, so repeated regional
+          analyses on the same grid reuse them. The returned mask is read
+          only.
+    """
+    rings = polygons_rings(polygons)
+    key = _key(Lon, Lat, *[r for shell, holes in rings
+        for r in [shell] + holes])
+
+    if key in _mask_cache:
+        _mask_cache[key] = _mask_cache.pop(key)
+    else:
+        mask = points_in_polygons(Lon, Lat, rings)
+        mask.flags.writeable = False
+        _mask_cache[key] = mask
+        while len(_mask_cache) > MASK_CACHE_SIZE:
+            _mask_cache.popitem(last=False)
+    return _mask_cache[key]
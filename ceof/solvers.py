@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Solvers to decompose the complex field U
+
+    All the solvers follow the convention of pyclimate.svdeofs.svdeofs,
+      i.e. U = pcs * eofs.T and lambdas = s**2/T, where s are the singular
+      values of U and T the number of time steps (first dimension).
+
+    Each solver returns pcs, lambdas, eofs and the total variance, which is
+      the trace of U^H U / T, so that the variance fraction can be estimated
+      even when only the leading modes are computed.
+"""
+
+import numpy as np
+
+
+def totalvariance(U):
+    """ Total variance of U, i.e. trace(U^H U)/T, without the covariance
+    """
+    return np.vdot(U, U).real / U.shape[0]
+
+
+def svd_full(U, nmodes=None):
+    """ Full decomposition with pyclimate's svdeofs
+
+        nmodes is ignored, all modes are computed.
+    """
+    from pyclimate.svdeofs import svdeofs
+
+    pcs, lambdas, eofs = svdeofs(U)
+    return pcs, lambdas, eofs, lambdas.sum()
+
+
+def svd_randomized(U, nmodes, oversampling=10, power_iterations=2,
+        seed=None, initial=None):
+    """ Leading nmodes by a randomized range finder
+
+        The range of U is sampled with nmodes + oversampling random
+          vectors, refined with power_iterations, and then the SVD is
+          estimated on that small subspace (Halko et al. 2011). Compute
+          and memory scale with nmodes instead of min(T, N).
+
+        initial (N, l), like conj(eofs) of a previous solution of a
+          similar U, replaces the first l random vectors, so a warm start
+          needs fewer power_iterations.
+    """
+    T, N = U.shape
+    assert nmodes <= min(T, N), \
+            "nmodes must be at most %s" % min(T, N)
+    L = min(nmodes + oversampling, T, N)
+
+    rng = np.random.RandomState(seed)
+    omega = (rng.standard_normal((N, L)) +
+            1j * rng.standard_normal((N, L))).astype(U.dtype)
+    if initial is not None:
+        l = min(initial.shape[1], L)
+        omega[:, :l] = initial[:, :l]
+
+    Q, R = np.linalg.qr(U.dot(omega))
+    for i in range(power_iterations):
+        # U^H Q as (Q^H U)^H, to avoid a conjugated copy of U
+        Z, R = np.linalg.qr(Q.conj().T.dot(U).conj().T)
+        Q, R = np.linalg.qr(U.dot(Z))
+
+    u, s, vh = np.linalg.svd(Q.conj().T.dot(U), full_matrices=False)
+
+    pcs = Q.dot(u[:, :nmodes]) * s[:nmodes]
+    lambdas = s[:nmodes]**2 / T
+    eofs = vh[:nmodes].T
+    return pcs, lambdas, eofs, totalvariance(U)
+
+
+def svd_arpack(U, nmodes, **keywords):
+    """ Leading nmodes by the Lanczos method (ARPACK)
+
+        Extra keywords are passed to scipy.sparse.linalg.svds.
+    """
+    from scipy.sparse.linalg import svds
+
+    T, N = U.shape
+    # svds solves the eigenproblem of the smaller side, n x n, where
+    #   ARPACK requires k < n - 1
+    assert nmodes < min(T, N) - 1, \
+            "ARPACK requires nmodes smaller than %s" % (min(T, N) - 1)
+
+    u, s, vh = svds(U, k=nmodes, **keywords)
+    # svds doesn't guarantee the order
+    ind = np.argsort(s)[::-1]
+    u, s, vh = u[:, ind], s[ind], vh[ind]
+
+    pcs = u * s
+    lambdas = s**2 / T
+    eofs = vh.T
+    return pcs, lambdas, eofs, totalvariance(U)
+
+
+def svd_gram(U, nmodes=None, side=None):
+    """ Method of snapshots, eigendecomposition of the smaller Gram matrix
+
+        The Hermitian cross product is formed on the smaller side of U,
+          T x T (side='time') or N x N (side='space'). If side is None it
+          is chosen from the shape of U. The other side is recovered with
+          one matrix product. Only the upper triangle is computed (BLAS
+          herk), and if nmodes is given only the leading eigenpairs are
+          estimated.
+
+        Forming the Gram matrix squares the condition number, so while the
+          lambdas agree with svdeofs to about 1e-12 relative to lambdas[0],
+          the pcs/eofs of modes with lambdas below ~1e-8*lambdas[0] lose
+          precision. Resolved modes agree with svdeofs to ~1e-8, apart
+          from the arbitrary unit phase of each mode. Modes with lambdas
+          below eps*n*lambdas[0], the round-off of the eigendecomposition
+          of the n x n Gram matrix, are null and dropped, so fewer than
+          nmodes modes are returned for a rank deficient U, like the
+          analytic signal with N > T/2 + 1, which has only about T/2 + 1
+          frequencies.
+    """
+    from scipy.linalg import eigh
+    from scipy.linalg.blas import get_blas_funcs
+
+    T, N = U.shape
+    if side is None:
+        side = 'time' if T <= N else 'space'
+    assert side in ('time', 'space'), "side must be time or space"
+
+    M = min(T, N)
+    if nmodes is None:
+        nmodes = M
+    assert nmodes <= M, "nmodes must be at most %s" % M
+
+    # U.T is a view, and for a C contiguous U it is what BLAS expects.
+    #   With it, herk gives conj(U U^H) or U^T conj(U), whose eigenvectors
+    #   are conj(left singular vectors) or conj(V), i.e. the eofs.
+    herk = get_blas_funcs('herk', (U,))
+    if side == 'time':
+        G = herk(1.0, U.T, trans=2)
+    else:
+        G = herk(1.0, U.T, trans=0)
+    n = G.shape[0]
+    totalvar = np.trace(G).real / T
+    w, vecs = eigh(G, lower=False, overwrite_a=True,
+            subset_by_index=[n - nmodes, n - 1])
+    del G
+    w, vecs = w[::-1], vecs[:, ::-1]
+
+    # The eigenvalues are sorted, so the resolved modes are the leading
+    #   ones, above the round-off of G. Null modes would give null pcs,
+    #   that scaleEOF can't scale.
+    resolved = w > w[0] * np.finfo(w.dtype).eps * n
+    nmodes = max(1, int(resolved.sum()))
+    w, vecs = w[:nmodes], vecs[:, :nmodes]
+    s = np.sqrt(w)
+
+    if side == 'time':
+        pcs = vecs.conj() * s
+        eofs = U.T.dot(vecs) / s
+    else:
+        eofs = vecs
+        pcs = U.dot(vecs.conj())
+
+    lambdas = w / T
+    return pcs, lambdas, eofs, totalvar
+
+
+SOLVERS = {'svdeofs': svd_full,
+        'randomized': svd_randomized,
+        'arpack': svd_arpack,
+        'gram': svd_gram,
+        }
+
+
+def decompose(U, solver='svdeofs', nmodes=None, **keywords):
+    """ (pcs, lambdas, eofs, totalvar) of the analytic signal U by solver
+
+        nmodes, like cfg['maxnmodes'], is a cap: it is clipped to the
+          modes that U has, min(T, N), or min(T, N) - 2 for ARPACK.
+    """
+    assert solver in SOLVERS, "Unknown solver: %s" % solver
+    if solver in ('randomized', 'arpack'):
+        assert nmodes is not None, \
+            "The %s solver requires the number of modes" % solver
+    if nmodes is not None:
+        nmodes = min(nmodes, min(U.shape) - (2 if solver == 'arpack' else 0))
+    return SOLVERS[solver](U, nmodes, **keywords)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Persistent on-disk store of CEOF results
+
+    A result set is a directory with one uncompressed .npy member per
+      array, plus a <name>.mask.npy for the masked ones, and an
+      attributes.pkl with the metadata and the non array items.
+
+    load() returns a CEOFStore, where each array is memory mapped only
+      when first accessed, so reading one PC doesn't touch the EOF cube.
+      The gridded arrays of the modes (J, K, nmodes), as the eofs, are
+      stored mode-major, (nmodes, J, K), and loaded as a transposed view,
+      so slicing a mode, eofs[..., n], only reads the pages of that mode.
+"""
+
+try:
+    from UserDict import UserDict
+except ImportError:
+    from collections import UserDict
+
+import os
+import pickle
+
+import numpy as np
+from numpy import ma
+
+
+# Items of a CEOF saved by default, when present
+RESULTS = ('eofs', 'pcs', 'lambdas', 'variancefraction', 'L_x', 'L_y',
+        'dx_eof_phase', 'dy_eof_phase', 'c_x', 'c_y', 'pc_frequency', 'lat',
+        'lon', 'datetime')
+
+# Gridded items (J, K, nmodes) stored mode-major
+MODE_MAJOR = ('eofs', 'L_x', 'L_y', 'dx_eof_phase', 'dy_eof_phase', 'c_x',
+        'c_y')
+
+
+def _save_npy(filename, value, mode_major=False):
+    if not mode_major:
+        np.save(filename, value)
+        return
+    # One mode at a time, without a transposed copy of value
+    output = np.lib.format.open_memmap(filename, mode='w+',
+            dtype=value.dtype, shape=value.shape[-1:] + value.shape[:-1])
+    for n in range(value.shape[-1]):
+        output[n] = value[..., n]
+    output.flush()
+    del output
+
+
+def _save_array(path, name, value, mode_major=False):
+    _save_npy(os.path.join(path, name + '.npy'), ma.getdata(value),
+            mode_major)
+    masked = ma.isMaskedArray(value) and (ma.getmask(value) is not ma.nomask)
+    if masked:
+        _save_npy(os.path.join(path, name + '.mask.npy'),
+                ma.getmaskarray(value), mode_major)
+    return masked
+
+
+def save(ceof, path, keys=None):
+    """ Save the results of ceof into the directory path
+
+        ceof can be a CEOF or a dict as returned by CEOF_2D. The keys
+          saved are RESULTS, if present, or keys, which a lazy CEOF
+          evaluates. The grid_index, halfpower_period and metadata
+          attributes of a CEOF are also saved. The MODE_MAJOR items are
+          stored as (nmodes, J, K).
+    """
+    if keys is None:
+        keys = [k for k in RESULTS if k in ceof]
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    attributes = {'metadata': getattr(ceof, 'metadata', {}),
+            'arrays': {}, 'objects': {}, 'mode_major': []}
+    for k in keys:
+        value = ceof[k]
+        if isinstance(value, np.ndarray):
+            mode_major = (k in MODE_MAJOR) and (value.ndim == 3)
+            attributes['arrays'][k] = _save_array(path, k, value, mode_major)
+            if mode_major:
+                attributes['mode_major'].append(k)
+        else:
+            attributes['objects'][k] = value
+    if hasattr(ceof, 'grid_index'):
+        attributes['arrays']['grid_index'] = _save_array(path, 'grid_index',
+                ceof.grid_index)
+    if hasattr(ceof, 'halfpower_period'):
+        attributes['objects']['halfpower_period'] = ceof.halfpower_period
+
+    with open(os.path.join(path, 'attributes.pkl'), 'wb') as f:
+        pickle.dump(attributes, f, protocol=2)
+    return
+
+
+class CEOFStore(UserDict):
+    """ CEOF results saved by save(), loaded lazily
+
+        The arrays are memory mapped read only on the first access through
+          the dict interface, and kept for the next ones.
+    """
+    def __init__(self, path):
+        UserDict.__init__(self)
+        self.path = path
+        with open(os.path.join(path, 'attributes.pkl'), 'rb') as f:
+            attributes = pickle.load(f)
+        self.metadata = attributes['metadata']
+        self.arrays = attributes['arrays']
+        # Stores saved before MODE_MAJOR have none
+        self.mode_major = attributes.get('mode_major', [])
+        self.data.update(attributes['objects'])
+        if 'halfpower_period' in self.data:
+            self.halfpower_period = self.data.pop('halfpower_period')
+
+    def _load_npy(self, name, filename):
+        value = np.load(os.path.join(self.path, filename), mmap_mode='r')
+        if name in self.mode_major:
+            # Back to (J, K, nmodes), as a view
+            value = np.moveaxis(value, 0, -1)
+        return value
+
+    def _load(self, name):
+        value = self._load_npy(name, name + '.npy')
+        if self.arrays[name]:
+            mask = self._load_npy(name, name + '.mask.npy')
+            value = ma.masked_array(value, mask=mask, copy=False)
+        return value
+
+    def __missing__(self, key):
+        if key not in self.arrays:
+            raise KeyError(key)
+        self.data[key] = self._load(key)
+        return self.data[key]
+
+    def __contains__(self, key):
+        return (key in self.data) or (key in self.arrays)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(self.data.keys()) + \
+                [k for k in self.arrays if k not in self.data]
+
+    @property
+    def grid_index(self):
+        return self['grid_index']
+
+
+def load(path):
+    """ Load lazily the CEOF results saved in path
+    """
+    return CEOFStore(path)
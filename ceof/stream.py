@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Out-of-core CEOF, streaming the field in spatial blocks
+
+    The field is never loaded as a whole. The first pass reads blocks of
+      columns, applies the Hilbert transform and accumulates the T x T
+      complex Gram matrix. The second pass reads the blocks again and
+      writes the EOFs of each block straight to the output. The peak of
+      memory is O(T**2 + T*blocksize) instead of O(T*N).
+"""
+
+import logging
+
+import numpy as np
+from numpy import ma
+from scipy.linalg import eigh
+from scipy.linalg.blas import get_blas_funcs
+
+from utils import analytic_signal, scaleEOF, select_nmodes, pack, \
+        HILBERT_BLOCK_ELEMENTS
+
+
+logger = logging.getLogger('ceof.stream')
+
+def _blocks(N, blocksize):
+    for n in range(0, N, blocksize):
+        yield slice(n, min(n + blocksize, N))
+
+
+def _read_block(source, cols, index=None):
+    """ Load one block of columns of source as an ndarray
+
+        If index is given, source is gridded (T, J, K) and the columns are
+          the points index[cols], packed on the fly. A masked source, like
+          a memmap in a masked array, must have no masked values on them.
+    """
+    if index is None:
+        block = source[:, cols]
+    else:
+        block = pack(source, index[cols])
+    assert not ma.getmaskarray(block).any(), \
+            "CEOF_2D_stream requires valid values, select them by index"
+    block = np.asarray(ma.getdata(block))
+    assert np.isfinite(block).all(), \
+            "CEOF_2D_stream requires valid values, select them by index"
+    return block
+
+
+def _eofs_output(eofs_out, shape, dtype):
+    if eofs_out is None:
+        return np.empty(shape, dtype=dtype)
+    elif isinstance(eofs_out, str):
+        return np.lib.format.open_memmap(eofs_out, mode='w+', dtype=dtype,
+                shape=shape)
+    assert eofs_out.shape == shape, \
+            "eofs_out must have shape %s, got %s" % (shape, eofs_out.shape)
+    return eofs_out
+
+
+def gram_stream(source, blocksize=None, index=None):
+    """ Accumulate conj(U U^H) over blocks of columns of source
+
+        source is a 2D (T, N) array like, as a numpy.memmap, a h5py
+          Dataset or a zarr Array, which is read by blocks of columns.
+          With index, source is a gridded (T, J, K) array like, and the
+          columns are its points index, as in utils.pack(source, index).
+        Only the upper triangle is filled.
+    """
+    T = source.shape[0]
+    N = source.shape[1] if index is None else len(index)
+    if blocksize is None:
+        blocksize = max(1, HILBERT_BLOCK_ELEMENTS // T)
+
+    G = None
+    for cols in _blocks(N, blocksize):
+        U = analytic_signal(_read_block(source, cols, index))
+        if G is None:
+            herk = get_blas_funcs('herk', (U,))
+            G = np.zeros((T, T), dtype=U.dtype, order='F')
+        G = herk(1.0, U.T, beta=1.0, c=G, trans=2, overwrite_c=True)
+    return G
+
+
+def CEOF_2D_stream(source, cfg=None, eofs_out=None, index=None):
+    """ Complex EOF of a 2D (T, N) field that doesn't fit in memory
+
+        Equivalent to CEOF_2D(source[:], cfg) with the gram solver, but
+          reading source in blocks of cfg['blocksize'] columns (default
+          is about HILBERT_BLOCK_ELEMENTS elements per block).
+
+        A 3D (T, J, K) numpy.memmap can be used as source.reshape(T, -1),
+          which is a view without copy, if all its values are valid. For a
+          field with land or gaps, give source as (T, J, K) with index, the
+          flat indices of the valid points on the (J, K) grid, as for
+          utils.analytic_signal(). Each block is packed on the fly, and N
+          is len(index). source can be a masked array, like a memmap with
+          its mask, as long as the points index aren't masked.
+
+        The EOFs are written, block by block, into eofs_out, which can be
+          a (N, nmodes) complex array like (memmap, h5py, zarr...), or a
+          filename for a new .npy memmap. If eofs_out is None, the EOFs are
+          kept in memory. With index, they are packed, see utils.unpack().
+
+        Only the pc_* normalizations are available here, since the scale
+          factors must be known before the EOFs are written.
+    """
+    if index is None:
+        assert source.ndim == 2, "CEOF_2D_stream requires a 2D array like"
+    else:
+        assert source.ndim == 3, \
+                "CEOF_2D_stream requires a 3D array like with index"
+        index = np.asarray(index)
+
+    if cfg is None:
+        cfg = {'cumvar':1, 'normalize':'pc_median'}
+    assert type(cfg) is dict, "cfg must be a dictionary"
+    if 'normalize' in cfg:
+        assert cfg['normalize'] in ('pc_std', 'pc_median', 'pc_max'), \
+                "CEOF_2D_stream can only normalize by the PCs"
+
+    T = source.shape[0]
+    N = source.shape[1] if index is None else len(index)
+    blocksize = cfg.get('blocksize', max(1, HILBERT_BLOCK_ELEMENTS // T))
+
+    # ---- First pass, the Gram matrix
+    G = gram_stream(source, blocksize, index)
+    totalvar = np.trace(G).real / T
+    w, vecs = eigh(G, lower=False, overwrite_a=True)
+    del G
+    w, vecs = w[::-1], vecs[:, ::-1]
+    # Only the modes above the round-off of G are resolved, as in
+    #   solvers.svd_gram, which is about T/2 + 1 modes for N > T/2 + 1
+    resolved = w > w[0] * np.finfo(w.dtype).eps * T
+    w = w[:max(1, int(resolved.sum()))]
+
+    lambdas = w / T
+    expvar = lambdas / totalvar
+    nmodes = select_nmodes(expvar, cfg)
+    logger.info("Considering the first %s of %s modes.", nmodes, len(lambdas))
+
+    s = np.sqrt(w[:nmodes])
+    vecs = vecs[:, :nmodes]
+    pcs = vecs.conj() * s
+    # eofs = U^T W, so W carries the 1/s factor and the normalization
+    W = vecs / s
+
+    # ---- Normalize -----------------------------------------------------
+    if 'normalize' in cfg:
+        pcs, W = scaleEOF(pcs, W, scaletype=cfg['normalize'])
+
+    # ---- Second pass, the EOFs
+    eofs = _eofs_output(eofs_out, (N, nmodes), W.dtype)
+    for cols in _blocks(N, blocksize):
+        U = analytic_signal(_read_block(source, cols, index))
+        eofs[cols] = U.T.dot(W)
+    if hasattr(eofs, 'flush'):
+        eofs.flush()
+
+    output = {}
+    output['eofs'] = eofs
+    output['pcs'] = pcs
+    output['lambdas'] = lambdas[:nmodes]
+    output['variancefraction'] = expvar[:nmodes]
+
+    return output
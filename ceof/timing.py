@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Timing and peak of memory of the stages of the CEOF pipeline
+
+    Each stage is timed and the high-water mark of the resident memory of
+      the process (maxrss) is sampled before and after it. If tracemalloc
+      is tracing, the traced peak of each stage is also recorded, which
+      resets the peak of tracemalloc at the start of each stage.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def maxrss():
+    """ High-water mark of the resident memory of the process, in bytes
+
+        None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux and BSD give kilobytes
+        rss *= 1024
+    return rss
+
+
+class StageProfiler(object):
+    """ Records time and memory of named stages in the dict profile
+
+        Each record has the time, in seconds, maxrss after the stage and
+          maxrss_increase during it, in bytes, and traced_peak if
+          tracemalloc is tracing. The records are logged at the INFO level
+          and, if given, passed to callback(name, record), for instance to
+          export them to a metrics system.
+
+        When disabled, stage() does nothing.
+    """
+    def __init__(self, logger=None, callback=None, enabled=True):
+        if logger is None:
+            logger = logging.getLogger('ceof')
+        self.logger = logger
+        self.callback = callback
+        self.enabled = enabled
+        self.profile = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """ Context of the stage name
+        """
+        if not self.enabled:
+            yield
+            return
+
+        tracing = (tracemalloc is not None) and tracemalloc.is_tracing() \
+                and hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            tracemalloc.reset_peak()
+        rss = maxrss()
+        t0 = time.time()
+
+        yield
+
+        record = {'time': time.time() - t0}
+        record['maxrss'] = maxrss()
+        if rss is not None:
+            record['maxrss_increase'] = record['maxrss'] - rss
+        if tracing:
+            record['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        self.profile[name] = record
+
+        if record['maxrss'] is None:
+            self.logger.info("Stage %s: %.3f s", name, record['time'])
+        else:
+            self.logger.info("Stage %s: %.3f s, maxrss %.1f MB (+%.1f MB)",
+                    name, record['time'], record['maxrss'] / 1e6,
+                    record['maxrss_increase'] / 1e6)
+        if self.callback is not None:
+            self.callback(name, record)
@@ -1,6 +1,152 @@
+import logging
+
 import numpy as np
+from numpy import ma
+
+try:
+    # scipy.fft keeps a cache of the FFT plans per length, so repeated
+    #   calls with the same number of time steps don't replan.
+    from scipy.fft import rfft, irfft
+except ImportError:
+    from numpy.fft import rfft, irfft
+
+from workers import map_blocks, split_blocksize
+
+
+logger = logging.getLogger('ceof.utils')
+
+# Maximum number of elements of one block in analytic_signal()
+HILBERT_BLOCK_ELEMENTS = 2**22
+
+_hilbert_kernels = {}
+
+
+def _hilbert_kernel(n):
+    """ Spectral multiplier of the Hilbert transform for a length n rfft
+
+        Same convention of scipy.fftpack.hilbert, i.e. y_j = i*sign(j)*x_j,
+          with the mean and, for an even n, the Nyquist mode set to zero.
+        The kernel is cached by n, ready to be broadcast along axis 1.
+    """
+    if n not in _hilbert_kernels:
+        h = np.empty(n // 2 + 1, dtype='complex128')
+        h[:] = 1j
+        h[0] = 0
+        if n % 2 == 0:
+            h[-1] = 0
+        _hilbert_kernels[n] = h[:, np.newaxis]
+    return _hilbert_kernels[n]
+
+
+def analytic_signal(data, blocksize=None, index=None, dtype=None,
+        n_workers=None):
+    """ Complex field data + i*H(data) using the Hilbert transform on axis 0
+
+        All columns are transformed at once with a real input FFT, so it is
+          equivalent to call scipy.fftpack.hilbert on each column of data,
+          but without the Python loop. The columns are processed in blocks
+          of blocksize columns to limit the peak of memory. If blocksize is
+          None, it is chosen so that each block has about
+          HILBERT_BLOCK_ELEMENTS elements.
+
+        If index is given, data is a gridded field (T, ..., J, K) and the
+          columns are the points index, as in pack(data, index). Each block
+          is packed on the fly, so the packed real field is never built, and
+          data can be a view or a memmap.
+
+        The output is complex64 for a float32 input, otherwise complex128.
+          dtype forces the real precision, like float32 for a single
+          precision output from a float64 input.
+
+        With n_workers, the blocks are transformed by a pool of threads,
+          see workers.map_blocks().
+    """
+    if index is None:
+        assert data.ndim == 2, "analytic_signal requires a 2D array"
+        T, N = data.shape
+    else:
+        T, N = data.shape[0], len(index)
+    if dtype is None:
+        dtype = data.dtype
+    if blocksize is None:
+        blocksize = max(1, HILBERT_BLOCK_ELEMENTS // max(T, 1))
+    blocksize = split_blocksize(N, blocksize, n_workers)
+
+    U = np.empty((T, N), dtype=np.result_type(dtype, np.complex64))
+    h = _hilbert_kernel(T)
+
+    def transform(cols):
+        if index is None:
+            block = data[:, cols]
+        else:
+            block = pack(data, index[cols])
+        block = np.asarray(block, dtype=U.real.dtype)
+        U.real[:, cols] = block
+        X = rfft(block, axis=0)
+        X *= h
+        U.imag[:, cols] = irfft(X, T, axis=0)
 
-def scaleEOF(pcs, eofs, scaletype):
+    map_blocks(transform, N, blocksize, n_workers)
+    return U
+
+
+def select_nmodes(expvar, cfg):
+    """ Number of modes to consider, from cfg['cumvar'] and cfg['maxnmodes']
+
+        expvar is the variance fraction of each mode.
+    """
+    # Define how many modes will be returned by the explainned variance.
+    # cumvar = 1 means 100%, i.e. all modes
+    if cfg['cumvar'] == 1:
+        nmodes = len(expvar)
+    else:
+        # The first modes that reach cumvar, including the one that does
+        ind = np.cumsum(expvar)>=cfg['cumvar']
+        if ind.any():
+            nmodes = int(np.argmax(ind)) + 1
+        else:
+            # A truncated solution might not reach cumvar
+            nmodes = len(expvar)
+
+    if 'maxnmodes' in cfg:
+        nmodes = min(nmodes, cfg['maxnmodes'])
+
+    return nmodes
+
+
+def ceof_output(result, cfg):
+    """ Output of CEOF_2D from a decomposition (pcs, lambdas, eofs, totalvar)
+
+        Selects the modes by cfg, see select_nmodes(), and normalizes them
+          if cfg['normalize'] is given.
+    """
+    pcs, lambdas, eofs, totalvar = result
+
+    expvar = lambdas / totalvar
+
+    nmodes = select_nmodes(expvar, cfg)
+
+    logger.info("Considering the first %s of %s modes.", nmodes, len(lambdas))
+
+    # The decomposition might be shared by the cache, so truncate on copies
+    #   and normalize only the modes kept.
+    eofs = eofs[:,:nmodes].copy()
+    pcs = pcs[:,:nmodes].copy()
+
+    # ---- Normalize -----------------------------------------------------
+    if 'normalize' in  cfg:
+        pcs, eofs = scaleEOF(pcs, eofs, scaletype=cfg['normalize'])
+
+    output = {}
+    output['eofs'] = eofs
+    output['pcs'] = pcs
+    output['lambdas'] = lambdas[:nmodes]
+    output['variancefraction'] = expvar[:nmodes]
+
+    return output
+
+
+def scaleEOF(pcs, eofs, scaletype, full_output=False):
     """ Scale the EOFS and PCS preserving the mode
 
         If scaled by the pcmedian:
@@ -8,118 +154,233 @@ def scaleEOF(pcs, eofs, scaletype):
             eof = eof*median(pc)
         This is the scale that I most use. On this case, the EOF structure
           has that magnitude at least half of the timeseries.
+
+        The scale factors of all modes are estimated at once, and applied
+          in place. The eofs can be packed (N, nmodes) or gridded, like
+          the masked (J, K, nmodes) of CEOF, with the modes in the last
+          dimension. With full_output, the factors are also returned, so
+          that pcs*fac and eofs/fac (or the opposite for eof_*) undo it.
     """
 
     assert pcs.ndim == 2
-    assert eofs.ndim == 2, "Expected a 2D EOF array."
     assert pcs.shape[-1] == eofs.shape[-1]
 
-    nmodes = pcs.shape[-1]
-
-    if scaletype == 'pc_std':
-        print("Normalizing by the pc_std")
-        for n in range(nmodes):
-            fac = (np.absolute(pcs[:,n])).std()
-            pcs[:,n] = pcs[:,n]/fac
-            eofs[:,n] = eofs[:,n]*fac
-
-    elif scaletype == 'pc_median':
-        print("Normalizing by the pc_median")
-        for n in range(nmodes):
-            fac = np.median((np.absolute(pcs[:,n])))
-            pcs[:,n] = pcs[:,n]/fac
-            eofs[:,n] = eofs[:,n]*fac
-
-    elif scaletype == 'pc_max':
-        print("Normalizing by the pc_max")
-        for n in range(nmodes):
-            fac = (np.absolute(pcs[:,n])).max()
-            pcs[:,n] = pcs[:,n]/fac
-            eofs[:,n] = eofs[:,n]*fac
-
-    elif scaletype == 'eof_std':
-        print("Normalizing by the eof_std")
-        for n in range(nmodes):
-            fac = (np.absolute(eofs[:,n])).std()
-            eofs[:,n] = eofs[:,n]/fac
-            pcs[:,n] = pcs[:,n]*fac
-
-    elif scaletype == 'eof_max':
-        print("Normalizing by the eof_max")
-        for n in range(nmodes):
-            fac = (np.absolute(eofs[:,n])).max()
-            eofs[:,n] = eofs[:,n]/fac
-            pcs[:,n] = pcs[:,n]*fac
-
+    if scaletype in ('pc_std', 'pc_median', 'pc_max'):
+        amp = np.absolute(pcs)
+    elif scaletype in ('eof_std', 'eof_max'):
+        amp = ma.absolute(eofs.reshape(-1, eofs.shape[-1]))
     else:
-        print("Don't understand the normalization config: %s" % scaletype)
+        logger.warning("Don't understand the normalization config: %s",
+                scaletype)
         return
 
+    if scaletype[-4:] == '_std':
+        fac = amp.std(axis=0)
+    elif scaletype[-7:] == '_median':
+        fac = np.median(amp, axis=0)
+    elif scaletype[-4:] == '_max':
+        fac = amp.max(axis=0)
+    fac = ma.getdata(fac)
+    del amp
+
+    if scaletype[:3] == 'pc_':
+        pcs /= fac
+        eofs *= fac
+    else:
+        eofs /= fac
+        pcs *= fac
+
+    if full_output:
+        return pcs, eofs, fac
     return pcs, eofs
 
 
-def ceof_reconstruct(eofs, pcs, nmodes=None):
-    """ Reconstruct the dataset from the sum of eofs*pcs
+def _reconstruct_operands(eofs, pcs, nmodes=None, modes=None):
+    """ Real operands A (T, 2m), B (N, 2m) so that A B^T = Re(pcs eofs^T)
 
-        If modes is 'all', uses all modes to reconstruct, otherwise it
-          is expected an integer, and will be the number of modes used.
+        Only the modes, or the nmodes first ones, are used. Gridded eofs
+          (..., m) are packed into their valid points, whose flat indices
+          are returned (None if all points are valid), with the grid shape.
     """
     assert eofs.shape[-1] == pcs.shape[-1], \
             "Last dimension of eofs must be equal to last dimension of pcs."
-    assert (nmodes == None) or (type(nmodes) == int), \
-            "Valid values for modes are: 'all' or an integer."
+    assert (nmodes is None) or (type(nmodes) == int), \
+            "Valid values for nmodes are: None or an integer."
 
-    if nmodes is None:
-        nmodes = list(range(pcs.shape[-1]))
-    else:
-        nmodes = list(range(nmodes))
+    if modes is None:
+        if nmodes is None:
+            nmodes = pcs.shape[-1]
+        modes = list(range(nmodes))
+    modes = list(modes)
+
+    shape = eofs.shape[:-1]
+    E = eofs.reshape(-1, eofs.shape[-1])
+    index = None
+    if ma.getmask(E) is not ma.nomask:
+        valid = ~ma.getmaskarray(E)[:, modes].any(axis=-1)
+        if not valid.all():
+            index = np.flatnonzero(valid)
+            E = E[index]
+    E = ma.getdata(E)[:, modes]
+    P = pcs[:, modes]
+
+    A = np.hstack((P.real, -P.imag))
+    B = np.hstack((E.real, E.imag))
+    return A, B, shape, index
+
+
+def _reconstruct_slab(A, B, shape, index):
+    """ Reconstructed (t, ...) slab, NaN out of the valid points
+    """
+    if index is None:
+        return A.dot(B.T).reshape((len(A),) + shape)
+    slab = np.empty((len(A), int(np.prod(shape))), dtype=B.dtype)
+    slab.fill(np.nan)
+    slab[:, index] = A.dot(B.T)
+    return slab.reshape((len(A),) + shape)
+
+
+def _reconstruct_chunksize(B, chunksize):
+    if chunksize is None:
+        chunksize = max(1, HILBERT_BLOCK_ELEMENTS // max(B.shape[0], 1))
+    return chunksize
+
+
+def reconstruct_slabs(eofs, pcs, nmodes=None, modes=None, chunksize=None):
+    """ Generator of the reconstructed dataset, chunksize time steps a time
+
+        Yields the slabs Re(pcs[t:t+chunksize] eofs^T), see
+          ceof_reconstruct(), so only one slab is in memory at a time.
+    """
+    A, B, shape, index = _reconstruct_operands(eofs, pcs, nmodes, modes)
+    chunksize = _reconstruct_chunksize(B, chunksize)
+    for t in range(0, A.shape[0], chunksize):
+        yield _reconstruct_slab(A[t:t+chunksize], B, shape, index)
+
+
+def ceof_reconstruct(eofs, pcs, nmodes=None, modes=None, out=None,
+        chunksize=None):
+    """ Reconstruct the dataset from the sum of eofs*pcs
 
-    print("Reconstructing from EOF using the modes: %s" % nmodes)
-    T = pcs.shape[-1]
+        The field is Re(pcs eofs^T), i.e. the sum along the modes of
+          |eof| |pc| cos(eof_phase + pc_phase), estimated as one real
+          matrix product per chunk of chunksize time steps.
 
-    eof_amp = (eofs.real**2 + eofs.imag**2)**0.5
-    eof_phase = numpy.arctan2(eofs.imag, eofs.real)
-    pc_amp = (numpy.real(pcs)**2 + numpy.imag(pcs)**2)**0.5
-    pc_phase = numpy.arctan2(numpy.imag(pcs), numpy.real(pcs))
+        If nmodes is None, uses all modes to reconstruct, otherwise it
+          is expected an integer, and will be the number of modes used.
+          Alternatively, modes can be an arbitrary list of modes.
 
-    data = np.zeros([T] + list(eofs.shape[:-1]))
+        The eofs can be packed (N, nmodes) or gridded (..., nmodes), as the
+          masked (J, K, nmodes) of CEOF. The output is written in out, which
+          can be an array (T, ...) or a filename for a new .npy memmap, with
+          NaN where the eofs are masked. If out is None, a full array is
+          allocated, masked where the eofs are masked.
+    """
+    A, B, shape, index = _reconstruct_operands(eofs, pcs, nmodes, modes)
+    logger.info("Reconstructing from EOF using %s modes", A.shape[1] // 2)
 
-    assert (eofs.ndim == 3), "Sorry, I only able to handle a 3D EOF array."
+    T = A.shape[0]
+    oshape = (T,) + shape
+    if out is None:
+        data = np.empty(oshape, dtype=B.dtype)
+    elif isinstance(out, str):
+        data = np.lib.format.open_memmap(out, mode='w+', dtype=B.dtype,
+                shape=oshape)
+    else:
+        assert out.shape == oshape, \
+                "out must have shape %s, got %s" % (oshape, out.shape)
+        data = out
 
-    for t in range(T):
-        for n in modes:
-            data[t] = data[t] + eof_amp[:,:,n] * pc_amp[t,n] * \
-                    numpy.cos(eof_phase[:,:,n] + pc_phase[t,n])
+    chunksize = _reconstruct_chunksize(B, chunksize)
+    for t in range(0, T, chunksize):
+        data[t:t+chunksize] = _reconstruct_slab(A[t:t+chunksize], B,
+                shape, index)
 
+    if hasattr(data, 'flush'):
+        data.flush()
+    if (out is None) and (index is not None):
+        data = ma.masked_invalid(data, copy=False)
     return data
 
 
+def eof_projection(eofs):
+    """ Projection matrix (N, nmodes) of the packed eofs
+
+        conj(eofs) with each mode divided by its squared norm, so that, the
+          eofs being orthogonal, U.dot(eof_projection(eofs)) are the pcs of
+          the analytic signal U on them, whatever the normalization of the
+          modes by scaleEOF().
+    """
+    eofs = ma.getdata(eofs)
+    norm = (eofs.real**2 + eofs.imag**2).sum(axis=0)
+    return eofs.conj() / norm
+
+
+def ceof_transform(data, projection, index=None, dtype=None, n_workers=None):
+    """ PCs (T', nmodes) of new data on modes already fitted
+
+        projection is eof_projection() of the packed eofs (N, nmodes) of
+          the fit. data is a real field (T', N), or a gridded (T', J, K)
+          with index, the flat indices of the points of the fit, whose
+          analytic signal is estimated as in the fit, see analytic_signal().
+          A complex data is taken as the analytic signal itself. Then the
+          pcs are a single (T', N) x (N, nmodes) matrix product.
+
+        The Hilbert transform is over the new window alone, so its first
+          and last time steps are distorted, as the ends of the original
+          record, and the new data must be filtered as the fitted one if
+          a prefilter was used.
+    """
+    if np.iscomplexobj(data):
+        U = data
+    else:
+        mask = ma.getmask(data)
+        if mask is not ma.nomask:
+            if index is not None:
+                mask = pack(mask, index)
+            assert not mask.any(), \
+                "ceof_transform requires valid values on the fitted points"
+        U = analytic_signal(ma.getdata(data), index=index, dtype=dtype,
+                n_workers=n_workers)
+    return U.dot(projection)
+
+
+def pack(field, index):
+    """ Gather the points index of a gridded field (..., J, K) into (..., N)
+
+        index are the flat indices on the (J, K) grid, as given by
+          numpy.flatnonzero(ind) for a boolean mask ind of valid points.
+          The gather is a single fancy indexing operation.
+    """
+    j, k = np.unravel_index(index, field.shape[-2:])
+    return field[..., j, k]
+
+
+def unpack(values, index, shape):
+    """ Scatter packed values (N, ...) back into a masked grid (J, K, ...)
+
+        Inverse of pack() for the first dimension of values. The points out
+          of index are masked.
+    """
+    output = ma.masked_all(tuple(shape) + values.shape[1:],
+            dtype=values.dtype)
+    output.reshape((-1,) + values.shape[1:])[index] = values
+    return output
+
+
 def gridto2D(self, var, ind=None):
     """
     """
     I, J, K = self.data[var].shape
 
-    if ind == None:
-        ind = numpy.ones((J,K))==1
+    if ind is None:
+        ind = np.ones((J,K), dtype=bool)
 
-    N = ((numpy.ones(ind.shape)[ind]).sum())
+    index = np.flatnonzero(ind)
 
     self.data2D = {}
-    for k in ['lat','lon']:
-        self.data2D[k] = ma.masked_all(N, dtype=self.data[k].dtype)
-
-    self.data2D['grid_index'] = ma.masked_all((N, 2))
-
-    for k in [var]:
-        self.data2D[k] = ma.masked_all((I,N), dtype=self.data[k].dtype)
-
-    n=-1
-    for j in range(J):
-        for k in range(K):
-            if ind[j, k]:
-                n += 1
-                self.data2D['grid_index'][n] = numpy.array([j,k])
-                self.data2D['lat'][n] = self.data['Lat'][j,k]
-                self.data2D['lon'][n] = self.data['Lon'][j,k]
-                self.data2D[var][:,n] = self.data[var][:,j,k]
+    self.data2D['grid_index'] = np.argwhere(ind)
+    self.data2D['lat'] = pack(self.data['Lat'], index)
+    self.data2D['lon'] = pack(self.data['Lon'], index)
+    self.data2D[var] = pack(self.data[var], index)
     return
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Wavelengths and phase speeds of the CEOF modes
+
+    The phase gradient of a mode is taken from the complex EOF itself, as
+      the angle of E[k+1] conj(E[k-1]), which is the centred difference of
+      the phase already unwrapped to (-pi, pi], for all the modes at once.
+      No phase field, nor a wrapped copy of it, is built.
+
+    With the convention of analytic_signal(), a wave cos(k.x - w t) gives
+      eofs ~ exp(i k.x) and pcs ~ exp(-i w t), so the phase speed along x
+      is w/kx, positive for a wave moving eastward.
+"""
+
+import numpy as np
+from numpy import ma
+
+from workers import map_blocks, split_blocksize
+
+
+# Mean radius of the Earth [m]
+EARTH_RADIUS = 6371e3
+
+
+def grid_spacing(lon, lat):
+    """ Centred grid spacing dX, dY [m] of a regular lon/lat grid (J, K)
+    """
+    dlon = np.deg2rad(np.gradient(np.asarray(lon, dtype='float64')))
+    dlat = np.deg2rad(np.gradient(np.asarray(lat, dtype='float64')))
+    dX = EARTH_RADIUS * np.outer(np.cos(np.deg2rad(lat)), dlon)
+    dY = EARTH_RADIUS * np.outer(dlat, np.ones(len(lon)))
+    return dX, dY
+
+
+def phase_gradient(eofs, axis, nmodes=None):
+    """ Centred difference of the phase of gridded eofs (J, K, m) on axis
+
+        The difference is in radians per grid step, for the first nmodes
+          modes, masked on the borders and next to masked points.
+    """
+    if nmodes is None:
+        nmodes = eofs.shape[-1]
+    E = ma.getdata(eofs[..., :nmodes])
+    mask = ma.getmaskarray(eofs[..., :nmodes])
+
+    n = E.shape[axis]
+    after = [slice(None)] * E.ndim
+    before = [slice(None)] * E.ndim
+    inner = [slice(None)] * E.ndim
+    after[axis], before[axis], inner[axis] = slice(2, n), slice(0, n-2), \
+            slice(1, n-1)
+    after, before, inner = tuple(after), tuple(before), tuple(inner)
+
+    output = ma.masked_all(E.shape, dtype=E.real.dtype)
+    output[inner] = ma.masked_array(
+            0.5 * np.angle(E[after] * E[before].conj()),
+            mask=mask[after] | mask[before])
+    return output
+
+
+def pc_frequency(pcs, nmodes=None):
+    """ Mean angular frequency of the first nmodes pcs [rad/time step]
+
+        The phase increments are averaged over the central half of the
+          record, where the Hilbert transform is not distorted by the ends,
+          weighted by the amplitude.
+    """
+    if nmodes is None:
+        nmodes = pcs.shape[-1]
+    T = pcs.shape[0]
+    P = pcs[T//4:T - T//4, :nmodes]
+    return -np.angle((P[1:] * P[:-1].conj()).sum(axis=0))
+
+
+def wavelength(eofs, pcs, lon, lat, dt=None, nmodes=None, n_workers=None):
+    """ Wavelengths and phase speeds of the gridded eofs (J, K, m)
+
+        Returns a dict with, for the first nmodes modes:
+          - dx_eof_phase, dy_eof_phase: phase differences [rad/grid step];
+          - L_x, L_y: wavelengths [km], positive for a phase increasing
+              eastward (northward);
+          - pc_frequency: angular frequency of the pcs [rad/s], or
+              [rad/time step] if dt, the time step in seconds, is None;
+          - c_x, c_y: phase speeds [m/s], or [m/time step].
+
+        With n_workers, blocks of modes run in a pool of threads.
+    """
+    if nmodes is None:
+        nmodes = eofs.shape[-1]
+    nmodes = min(nmodes, eofs.shape[-1])
+    dX, dY = grid_spacing(lon, lat)
+
+    shape = eofs.shape[:-1] + (nmodes,)
+    output = {}
+    for k in ('dx_eof_phase', 'dy_eof_phase', 'L_x', 'L_y', 'c_x', 'c_y'):
+        output[k] = ma.masked_all(shape)
+
+    w = pc_frequency(pcs, nmodes)
+    if dt is not None:
+        w = w / dt
+    output['pc_frequency'] = w
+
+    def block(modes):
+        for x, axis, spacing in (('x', 1, dX), ('y', 0, dY)):
+            dphase = phase_gradient(eofs[..., modes], axis)
+            output['d%s_eof_phase' % x][..., modes] = dphase
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                # Wavenumber [rad/m], masked where the phase is flat
+                k = ma.masked_equal(dphase, 0) / spacing[..., np.newaxis]
+                output['L_%s' % x][..., modes] = 2 * np.pi / k * 1e-3
+                output['c_%s' % x][..., modes] = w[modes] / k
+
+    map_blocks(block, nmodes, split_blocksize(nmodes, nmodes, n_workers),
+            n_workers)
+    return output
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Pool of threads for the block-parallel stages of the pipeline
+
+    The FFTs of scipy.fft and the NumPy array operations release the GIL,
+      so blocks of columns of the Hilbert transform, the prefilter and the
+      masking, or blocks of modes of the wavelength, run concurrently in
+      threads, on the same arrays, without copies.
+
+    n_workers caps the total of threads. The pool has n_workers threads
+      and, if threadpoolctl is available, the BLAS and OpenMP pools are
+      limited to n_workers threads within limit_threads(), so the SVD
+      doesn't oversubscribe the node either. With n_workers None the stages
+      are serial and the BLAS threads are left alone. A n_workers smaller
+      than 1 means all the CPUs.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def get_n_workers(n_workers=None):
+    """ Number of threads for n_workers
+    """
+    if n_workers is None:
+        return 1
+    if n_workers < 1:
+        return os.cpu_count() or 1
+    return int(n_workers)
+
+
+def split_blocksize(N, blocksize, n_workers=None):
+    """ blocksize reduced, if needed, so N gives a block for each worker
+    """
+    n = get_n_workers(n_workers)
+    if n > 1:
+        blocksize = min(blocksize, -(-N // n))
+    return max(1, blocksize)
+
+
+def map_blocks(func, N, blocksize, n_workers=None):
+    """ [func(cols)] for each slice cols of blocksize of range(N)
+
+        With more than one worker, the blocks run in a pool of threads.
+    """
+    blocks = [slice(n, min(n + blocksize, N)) for n in range(0, N, blocksize)]
+    n = min(get_n_workers(n_workers), len(blocks))
+    if n <= 1:
+        return [func(cols) for cols in blocks]
+    with ThreadPoolExecutor(n) as pool:
+        return list(pool.map(func, blocks))
+
+
+@contextmanager
+def limit_threads(n_workers=None):
+    """ Context where the BLAS and OpenMP threads are at most n_workers
+    """
+    if (n_workers is None) or (threadpool_limits is None):
+        yield
+        return
+    with threadpool_limits(limits=get_n_workers(n_workers)):
+        yield
@@ -51,9 +51,13 @@ setup(
         # Pick your license as you wish (should match "license" above)
         'License :: OSI Approved :: MIT License',
 
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 
+    # concurrent.futures, tracemalloc, os.cpu_count
+    python_requires='>=3.6',
+
     # What does your project relate to?
     keywords='sample setuptools development',
 
@@ -65,7 +69,9 @@ setup(
     # project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
-    install_requires=['numpy', 'scipy', 'pyclimate'],
+    # scipy>=1.5 for eigh(subset_by_index=...) of the gram solver, and
+    # threadpoolctl to cap the BLAS threads with n_workers.
+    install_requires=['numpy', 'scipy>=1.5', 'pyclimate', 'threadpoolctl'],
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
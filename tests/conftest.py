@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of ceof import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'ceof'))
@@ -0,0 +1,55 @@
+""" CEOF_batch against CEOF, one configuration at a time
+"""
+
+import copy
+import datetime
+
+import numpy as np
+from numpy import ma
+import pytest
+
+from ceof import CEOF
+from batch import CEOF_batch
+
+
+def input_data(T=120, J=10, K=12, gaps=0., seed=0):
+    rng = np.random.RandomState(seed)
+    lon = np.linspace(-60, -25, K)
+    lat = np.linspace(-5, 15, J)
+    t = np.arange(T)[:, np.newaxis, np.newaxis]
+    field = np.cos(2 * np.pi * (lon / 10. - t / 30.)) + \
+            0.5 * rng.standard_normal((T, J, K))
+    mask = np.zeros((T, J, K), dtype=bool)
+    mask[:] = rng.rand(J, K) < 0.1
+    mask |= rng.rand(T, J, K) < gaps
+    return {'ssh': ma.masked_array(field, mask=mask), 'lon': lon,
+            'lat': lat, 'datetime': [datetime.datetime(2000, 1, 1) +
+                datetime.timedelta(days=n) for n in range(T)]}
+
+
+CFG = {'var': 'ssh', 'cumvar': 1, 'maxnmodes': 3, 'normalize': 'pc_median',
+        'solver': 'gram'}
+BOX = [(-57, -3), (-28, -3), (-28, 13), (-57, 13)]
+
+
+@pytest.mark.parametrize('gaps, configurations', [
+    (0., {'all': {'ceof': dict(CFG)},
+        'box': {'ceof': dict(CFG), 'ceof_coord': BOX},
+        'filtered': {'ceof': dict(CFG), 'prefilter': {'type': 'lowpass',
+            'l': datetime.timedelta(days=10)}}}),
+    (0.1, {'gappy': {'ceof': dict(CFG, gappy=True)},
+        'gappy_box': {'ceof': dict(CFG, gappy={'tol': 1e-4}),
+            'ceof_coord': BOX}}),
+    ])
+@pytest.mark.parametrize('n_workers', [None, 2])
+def test_batch_as_ceof(gaps, configurations, n_workers):
+    data = input_data(gaps=gaps)
+    outputs = CEOF_batch(data, copy.deepcopy(configurations),
+            n_workers=n_workers)
+    for k, metadata in configurations.items():
+        metadata = dict(copy.deepcopy(metadata), wavelength=False)
+        x = CEOF(data, metadata)
+        assert (outputs[k]['grid_index'] == x.grid_index).all()
+        assert np.allclose(outputs[k]['lambdas'], x['lambdas'])
+        assert np.allclose(abs(outputs[k]['eofs']).filled(0),
+                abs(x['eofs']).filled(0))
@@ -0,0 +1,43 @@
+""" The CEOF class, on the field of test_batch
+"""
+
+import numpy as np
+import pytest
+
+from ceof import CEOF
+from cache import ResultCache
+from test_batch import input_data, CFG
+
+
+def test_cache_hit_skips_hilbert():
+    data = input_data()
+    rcache = ResultCache()
+    metadata = {'ceof': dict(CFG, cache=rcache), 'wavelength': False}
+    first = CEOF(data, metadata)
+    assert 'hilbert' in first.profile
+    assert rcache.stats.misses == 1
+
+    second = CEOF(data, metadata)
+    assert rcache.stats.hits == 1
+    assert 'hilbert' not in second.profile
+    assert np.allclose(second['lambdas'], first['lambdas'])
+    assert np.allclose(abs(second['eofs']).filled(0),
+            abs(first['eofs']).filled(0))
+
+
+def test_eager_drops_packed_eofs():
+    data = input_data()
+    metadata = {'ceof': dict(CFG), 'wavelength': False}
+    x = CEOF(data, metadata)
+    lazy = CEOF(data, metadata, lazy=True)
+    lazy.go()
+    assert 'packed_eofs' not in x.data
+    assert 'packed_eofs' in lazy.data
+
+    for nmodes, modes in [(None, None), (2, None), (None, [2, 0])]:
+        assert np.allclose(x.reconstruct(nmodes, modes).filled(0),
+                lazy.reconstruct(nmodes, modes).filled(0))
+    new = input_data(seed=1)['ssh'].filled(0)
+    assert np.allclose(x.transform(new), lazy.transform(new))
+    # Repacked on request
+    assert np.allclose(x['packed_eofs'], lazy['packed_eofs'])
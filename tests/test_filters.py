@@ -0,0 +1,57 @@
+""" Half power period of the prefilter
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+
+from filters import halfpower_period, prefilter
+
+try:
+    from scipy.fft import rfft, irfft
+except ImportError:
+    from numpy.fft import rfft, irfft
+
+
+def filtered(gain, T=256, N=50, seed=0):
+    """ White noise and its output by a filter of power gain(freq)
+    """
+    x = np.random.RandomState(seed).standard_normal((T, N))
+    freq = np.arange(T // 2 + 1) / float(T)
+    y = irfft(rfft(x, axis=0) * np.sqrt(gain(freq))[:, np.newaxis], T,
+            axis=0)
+    return x, y
+
+
+def rippled_highpass(freq):
+    # Crosses one half at 0.1, and back and forth around 0.3
+    gain = np.where(freq < 0.1, 0.1, 0.9)
+    gain[(freq > 0.25) & (freq < 0.3)] = 0.2
+    return gain
+
+
+def test_highpass_with_ripples():
+    x, y = filtered(rippled_highpass)
+    period = halfpower_period(x, y, type='highpass')
+    assert isinstance(period, float)
+    assert abs(period - 10) < 0.5
+    # Taken from the gain, it would look like a bandpass
+    assert isinstance(halfpower_period(x, y), tuple)
+
+
+def test_bandpass():
+    x, y = filtered(lambda f: np.where((f > 0.05) & (f < 0.2), 1., 0.))
+    long, short = halfpower_period(x, y, type='bandpass')
+    assert abs(long - 20) < 1
+    assert abs(short - 5) < 0.5
+
+
+@pytest.mark.parametrize('type', ['lowpass', 'highpass'])
+def test_prefilter_period(type):
+    T = 365
+    field = np.random.RandomState(0).standard_normal((T, 4, 5))
+    t = [datetime.datetime(2000, 1, 1) + datetime.timedelta(days=n)
+            for n in range(T)]
+    output, period = prefilter(field, t, datetime.timedelta(days=30), type)
+    assert isinstance(period, float)
@@ -0,0 +1,51 @@
+""" Filling of the gaps by the leading modes
+"""
+
+import numpy as np
+from numpy import ma
+
+import gappy
+
+
+def gappy_field(T=150, N=60, gaps=0.2, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(T)[:, np.newaxis]
+    x = np.arange(N)[np.newaxis]
+    field = np.cos(2 * np.pi * (x / 20. - t / 30.)) + \
+            0.5 * rng.standard_normal((T, N))
+    return ma.masked_array(field, mask=rng.rand(T, N) < gaps)
+
+
+def held_out(data, cv_fraction=0.03, seed=0):
+    gaps = ma.getmaskarray(data)
+    valid = np.flatnonzero(~gaps)
+    cv = np.random.RandomState(seed).choice(valid,
+            int(cv_fraction * valid.size), replace=False)
+    missing = gaps.copy()
+    missing.flat[cv] = True
+    return cv, missing
+
+
+def test_keeps_the_lowest_error():
+    data = gappy_field()
+    # Too many modes overfit, and the error goes up
+    result, solution = gappy.fill_gaps(data, 30, tol=-np.inf, maxiter=15)
+    errors = solution['cv_error']
+    assert errors.argmin() < len(errors) - 1
+
+    cv, missing = held_out(data)
+    X = np.zeros(data.shape)
+    X[missing] = solution['fill']
+    error = np.sqrt(((X.flat[cv] - ma.getdata(data).flat[cv])**2).mean())
+    assert np.allclose(error, errors.min())
+
+
+def test_rerun_with_other_options():
+    gappy._solutions.clear()
+    data = gappy_field(seed=1)
+    loose = gappy.decompose_gappy(data, 2, tol=0.5)
+    assert gappy.decompose_gappy(data, 2, tol=0.5) is loose
+    tight = gappy.decompose_gappy(data, 2, tol=1e-6)
+    assert tight is not loose
+    solution = list(gappy._solutions.values())[-1]
+    assert len(solution['cv_error']) > 1
@@ -0,0 +1,41 @@
+""" Selection of the grid points inside polygons
+"""
+
+import numpy as np
+import pytest
+
+from regions import points_in_polygons
+
+
+BOX = [(-57, -3), (-28, -3), (-28, 13), (-57, 13)]
+POLYGONS = [BOX,
+        [(-57, -3), (-28, -3), (-40, 13)],
+        (BOX, [[(-50, 0), (-40, 0), (-40, 5), (-50, 5)]]),
+        ]
+
+
+def grid(step=0.25):
+    return np.meshgrid(np.arange(-70, -20 + step / 2, step),
+            np.arange(-10, 20 + step / 2, step))
+
+
+def test_box_boundary_nodes():
+    Lon, Lat = grid()
+    mask = points_in_polygons(Lon, Lat, BOX)
+    expected = (Lon >= -57) & (Lon <= -28) & (Lat >= -3) & (Lat <= 13)
+    assert (mask == expected).all()
+    assert mask.sum() == 7605
+
+
+@pytest.mark.parametrize('polygon', POLYGONS)
+def test_as_shapely_intersects(polygon):
+    geometry = pytest.importorskip('shapely.geometry')
+    if isinstance(polygon, tuple):
+        shape = geometry.Polygon(*polygon)
+    else:
+        shape = geometry.Polygon(polygon)
+    Lon, Lat = grid(0.5)
+    mask = points_in_polygons(Lon, Lat, polygon)
+    expected = [shape.intersects(geometry.Point(x, y))
+            for x, y in zip(Lon.ravel(), Lat.ravel())]
+    assert (mask.ravel() == np.array(expected)).all()
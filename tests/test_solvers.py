@@ -0,0 +1,85 @@
+""" Agreement of the gram solver with svdeofs
+"""
+
+import numpy as np
+import pytest
+
+from utils import analytic_signal, ceof_reconstruct
+from solvers import svd_gram
+from ceof import CEOF_2D
+
+
+def reference(U, name):
+    """ (pcs, lambdas, eofs) of U as given by svdeofs
+    """
+    if name == 'svdeofs':
+        svdeofs = pytest.importorskip('pyclimate.svdeofs').svdeofs
+        return svdeofs(U)
+    # The same decomposition, with the convention of svdeofs
+    u, s, vh = np.linalg.svd(U, full_matrices=False)
+    return u * s, s**2 / U.shape[0], vh.T
+
+
+def field(T, N, seed=0):
+    return np.random.RandomState(seed).standard_normal((T, N))
+
+
+@pytest.mark.parametrize('name', ['svdeofs', 'numpy'])
+@pytest.mark.parametrize('shape', [(200, 40), (40, 200), (100, 500)])
+@pytest.mark.parametrize('side', ['time', 'space'])
+def test_gram_agrees_with_svdeofs(name, shape, side):
+    U = analytic_signal(field(*shape))
+    pcs, lambdas, eofs = reference(U, name)
+    gpcs, glambdas, geofs, totalvar = svd_gram(U, side=side)
+
+    # Only the resolved modes, i.e. the rank of U, are returned
+    rank = np.linalg.matrix_rank(U)
+    assert len(glambdas) == rank
+    assert np.allclose(totalvar, lambdas.sum())
+    assert np.allclose(glambdas, lambdas[:rank], rtol=0,
+            atol=1e-12 * lambdas[0])
+
+    # Modes above ~1e-8*lambdas[0], apart from a unit phase
+    for n in np.flatnonzero(glambdas > 1e-8 * glambdas[0]):
+        phase = np.vdot(geofs[:, n], eofs[:, n])
+        assert np.allclose(abs(phase), 1)
+        assert np.allclose(geofs[:, n] * phase, eofs[:, n], atol=1e-8)
+        assert np.allclose(gpcs[:, n] / phase, pcs[:, n],
+                atol=1e-8 * np.sqrt(lambdas[0] * shape[0]))
+
+
+@pytest.mark.parametrize('shape', [(200, 40), (100, 500)])
+def test_gram_default_cfg(shape):
+    x = field(*shape)
+    output = CEOF_2D(x, {'cumvar': 1, 'normalize': 'pc_median',
+        'solver': 'gram'})
+    assert np.isfinite(output['pcs']).all()
+    assert np.isfinite(output['eofs']).all()
+    # All the modes give back the field, the real part of its analytic
+    #   signal
+    assert np.allclose(ceof_reconstruct(output['eofs'], output['pcs']), x)
+
+
+def test_gram_float32_large_N():
+    # The cutoff of null modes scales with the Gram matrix (T x T), not
+    #   with N, or the float32 round-off drops real modes when N >> T
+    T, N = 200, 20000
+    rng = np.random.RandomState(0)
+    a = np.linalg.qr(rng.standard_normal((T, 12)))[0]
+    b = np.linalg.qr(rng.standard_normal((N, 12)))[0]
+    x = (a * np.sqrt(0.5**np.arange(12))).dot(b.T)
+    U = analytic_signal(x.astype('f4'))
+    assert U.dtype == np.complex64
+    pcs, lambdas, eofs, totalvar = svd_gram(U, 10)
+    assert len(lambdas) == 10
+    assert np.isfinite(pcs).all() and np.isfinite(eofs).all()
+    reference = svd_gram(analytic_signal(x), 10)[1]
+    assert np.allclose(lambdas, reference, rtol=1e-3)
+
+
+@pytest.mark.parametrize('solver', ['randomized', 'arpack', 'gram'])
+def test_maxnmodes_is_a_cap(solver):
+    x = field(30, 12)
+    output = CEOF_2D(x, {'cumvar': 1, 'solver': solver, 'maxnmodes': 50})
+    assert 0 < len(output['lambdas']) <= 12
+    assert np.isfinite(output['pcs']).all()
@@ -0,0 +1,29 @@
+""" Round trip of the CEOF results through store
+"""
+
+import os
+
+import numpy as np
+
+from ceof import CEOF
+import store
+from test_batch import input_data, CFG
+
+
+def test_save_load(tmpdir):
+    x = CEOF(input_data(), {'ceof': dict(CFG)})
+    path = str(tmpdir.join('results'))
+    store.save(x, path)
+    y = store.load(path)
+
+    assert (y.grid_index == x.grid_index).all()
+    for k in ('eofs', 'pcs', 'lambdas', 'L_x', 'c_y', 'pc_frequency'):
+        assert y[k].shape == x[k].shape
+        assert (np.ma.getmaskarray(y[k]) == np.ma.getmaskarray(x[k])).all()
+        assert np.allclose(np.ma.filled(y[k], 0), np.ma.filled(x[k], 0))
+
+    # Each mode of the EOF cube is contiguous on disk
+    J, K, nmodes = x['eofs'].shape
+    eofs = np.load(os.path.join(path, 'eofs.npy'), mmap_mode='r')
+    assert eofs.shape == (nmodes, J, K)
+    assert np.allclose(y['eofs'][..., 1].filled(0), x.eof(1).filled(0))
@@ -0,0 +1,49 @@
+""" CEOF_2D_stream against the in memory CEOF_2D
+"""
+
+import numpy as np
+import pytest
+
+from ceof import CEOF_2D
+from stream import CEOF_2D_stream
+from utils import ceof_reconstruct
+
+
+@pytest.mark.parametrize('shape', [(200, 40), (100, 500)])
+def test_stream_default_cfg(shape):
+    x = np.random.RandomState(0).standard_normal(shape)
+    output = CEOF_2D_stream(x, {'cumvar': 1, 'normalize': 'pc_median',
+        'blocksize': 64})
+    expected = CEOF_2D(x, {'cumvar': 1, 'normalize': 'pc_median',
+        'solver': 'gram'})
+    assert np.allclose(output['lambdas'], expected['lambdas'])
+    assert np.isfinite(output['pcs']).all()
+    assert np.allclose(ceof_reconstruct(output['eofs'], output['pcs']), x)
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_stream_index(tmpdir, masked):
+    T, J, K = 120, 12, 15
+    x = np.random.RandomState(0).standard_normal((T, J, K))
+    land = np.zeros((J, K), dtype=bool)
+    land[:4, :5] = True
+    source = np.lib.format.open_memmap(str(tmpdir.join('x.npy')),
+            mode='w+', shape=x.shape)
+    source[:] = x
+    if masked:
+        source = np.ma.masked_array(source,
+                mask=np.broadcast_to(land, x.shape))
+    else:
+        source[:, land] = np.nan
+    index = np.flatnonzero(~land)
+
+    cfg = {'cumvar': 1, 'normalize': 'pc_median', 'blocksize': 16}
+    output = CEOF_2D_stream(source, cfg, index=index)
+    expected = CEOF_2D_stream(x.reshape(T, -1)[:, index], cfg)
+    assert output['eofs'].shape == (len(index), len(output['lambdas']))
+    assert np.allclose(output['lambdas'], expected['lambdas'])
+    assert np.allclose(output['eofs'], expected['eofs'])
+
+    # Invalid points must be left out by index
+    with pytest.raises(AssertionError):
+        CEOF_2D_stream(source, cfg, index=np.arange(J * K))
@@ -0,0 +1,21 @@
+""" Selection of the number of modes
+"""
+
+import numpy as np
+import pytest
+
+from utils import select_nmodes
+
+
+@pytest.mark.parametrize('cumvar, nmodes', [(0.5, 1), (0.81, 1),
+    (0.85, 2), (0.95, 3), (0.99, 4), (1, 4)])
+def test_select_nmodes_cumvar(cumvar, nmodes):
+    expvar = np.array([0.81, 0.1, 0.05, 0.04])
+    assert select_nmodes(expvar, {'cumvar': cumvar}) == nmodes
+
+
+def test_select_nmodes_maxnmodes():
+    expvar = np.array([0.4, 0.3, 0.2, 0.1])
+    assert select_nmodes(expvar, {'cumvar': 0.95, 'maxnmodes': 2}) == 2
+    # A truncated solution that doesn't reach cumvar keeps all its modes
+    assert select_nmodes(expvar[:2], {'cumvar': 0.95}) == 2